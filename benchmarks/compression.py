@@ -0,0 +1,112 @@
+# Benchmark of vtr encodings and compressors
+"""
+Writes the same grid with random values (smoothed, to resemble tally
+results) with different encodings, compressors and compression levels of
+tovtk.vtr.write_vtr() and prints the write time and the file size.
+
+Usage:
+
+    >python compression.py [options]
+
+Options:
+
+    --shape NI NJ NK    Number of mesh elements in each direction (100 100 100)
+    --block-size B      Block size in bytes (32768)
+    --dir D             Directory for written files (data)
+    --out F             Results file (compression.jsonl)
+
+Settings with compressors, whose Python packages are not installed, are
+skipped. Results are appended to the results file as JSON objects, one per
+line.
+"""
+import os
+import sys
+import json
+import time
+
+# Benchmarks run on the tovtk package in this tree
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# (encoding, compressor, level) tuples, level None is the default
+SETTINGS = [('base64', 'none', None),
+            ('raw', 'none', None),
+            ('base64', 'zlib', 1),
+            ('base64', 'zlib', None),
+            ('base64', 'zlib', 9),
+            ('raw', 'zlib', None),
+            ('base64', 'lz4', None),
+            ('base64', 'lz4', 1),
+            ('raw', 'lz4', None),
+            ('base64', 'lzma', 1),
+            ('base64', 'lzma', None),
+            ('raw', 'lzma', None)]
+
+
+def _data(shape):
+    """
+    Returns bounds and cell arrays for the grid of the given shape.
+    """
+    from numpy import arange, cumsum, random
+    random.seed(1)
+    x, y, z = [arange(n + 1, dtype=float) for n in shape]
+    n = shape[0] * shape[1] * shape[2]
+    vals = cumsum(random.random(n)) / n
+    errs = random.random(n).round(4)
+    return x, y, z, [('val', vals), ('err', errs)]
+
+
+def main(args):
+    shape = [100, 100, 100]
+    block_size = 32768
+    dname = 'data'
+    out = 'compression.jsonl'
+    while args:
+        o = args.pop(0)
+        if o == '--shape':
+            shape = map(int, args[:3])
+            args = args[3:]
+        elif o == '--block-size':
+            block_size = int(args.pop(0))
+        elif o == '--dir':
+            dname = args.pop(0)
+        elif o == '--out':
+            out = args.pop(0)
+        else:
+            print __doc__
+            return 2
+    if not os.path.isdir(dname):
+        os.makedirs(dname)
+
+    sys.path.insert(0, _root)
+    from tovtk.vtr import write_vtr
+    x, y, z, cdata = _data(shape)
+    print '{:8s} {:6s} {:>5s} {:>10s} {:>10s} {:>7s}'.format(
+        'encoding', 'compr', 'level', 'wall, s', 'file, MB', 'ratio')
+    raw = None
+    for encoding, compressor, level in SETTINGS:
+        fname = os.path.join(dname, 'c{}x{}x{}.vtr'.format(*shape))
+        t0 = time.time()
+        try:
+            write_vtr(fname, x, y, z, cdata, [], encoding=encoding,
+                      compressor=compressor, level=level,
+                      block_size=block_size)
+        except ValueError as e:
+            print '{:8s} {:6s} skipped: {}'.format(encoding, compressor, e)
+            continue
+        wall = time.time() - t0
+        size = os.path.getsize(fname)
+        if raw is None:
+            raw = float(size)
+        res = {'shape': shape, 'block_size': block_size,
+               'encoding': encoding, 'compressor': compressor,
+               'level': level, 'wall': wall, 'bytes': size}
+        with open(out, 'a') as f:
+            f.write(json.dumps(res, sort_keys=True) + '\n')
+        print '{:8s} {:6s} {:>5s} {:10.3f} {:10.2f} {:7.3f}'.format(
+            encoding, compressor, str(level), wall, size / 2.**20,
+            size / raw)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
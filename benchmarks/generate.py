@@ -0,0 +1,157 @@
+# Generators of synthetic input files for benchmarks
+"""
+Writes synthetic meshtal, dgs, old-format dgs and fmc files of arbitrary size.
+
+Mesh elements are unit cubes, values are random. Data lines are formatted in
+chunks of CHUNK lines, so that files with about 10^8 mesh elements can be
+generated in reasonable time.
+
+Usage:
+
+    >python generate.py meshtal NI NJ NK [NE [NT]] fname
+    >python generate.py dgs NI NJ NK [NG] fname
+    >python generate.py dgs.old NI NJ NK [NG] fname
+    >python generate.py fmc NI NJ NK fname
+
+where NI, NJ, NK are numbers of mesh elements in each direction, NE is the
+number of energy bins, NT the number of tallies and NG the number of energy
+groups.
+"""
+from numpy import arange, column_stack, dstack, repeat, random
+
+# Number of data lines formatted at once
+CHUNK = 2**18
+
+random.seed(1)
+
+
+def _bounds(n, start=0.0):
+    return start + arange(n + 1, dtype=float)
+
+
+def _write_lines(f, fmt, rows):
+    """
+    Write rows of 2-dimensional array `rows` to file `f`, formatted with the
+    line format `fmt`.
+    """
+    for s in range(0, len(rows), CHUNK):
+        r = rows[s:s + CHUNK]
+        f.write((fmt * len(r)) % tuple(r.ravel()))
+
+
+def _cell_indices(ni, nj, nk, start, stop):
+    """
+    Returns array of the shape (stop - start, 3) with 1-based indices of mesh
+    elements start to stop-1, z index changing fastest.
+    """
+    n = arange(start, stop)
+    return column_stack((n // (nj*nk), n // nk % nj, n % nk)) + 1
+
+
+def meshtal(fname, ni, nj, nk, ne=1, nt=1):
+    """
+    Write meshtal file with `nt` rectangular mesh tallies with `ne` energy
+    bins on the (ni, nj, nk) mesh.
+    """
+    x, y, z = _bounds(ni, -ni*0.5), _bounds(nj, -nj*0.5), _bounds(nk)
+    ebins = 10.0**arange(-ne + 1, 1)
+    n = ni * nj * nk
+    with open(fname, 'w') as f:
+        f.write(' mcnp   version 6     ld=05/08/13  probid =  01/01/18 00:00:00 \n')
+        f.write(' Synthetic meshtal for benchmarks\n')
+        f.write(' Number of histories used for normalizing tallies ='
+                '      1000000.00\n')
+        for t in range(nt):
+            f.write('\n Mesh Tally Number {:9d}\n'.format(t*10 + 4))
+            f.write(' This is a neutron mesh tally.\n\n')
+            f.write(' Tally bin boundaries:\n')
+            for d, b in zip('XYZ', (x, y, z)):
+                f.write('    {} direction: '.format(d) +
+                        ' '.join('{:9.2f}'.format(v) for v in b) + '\n')
+            f.write('    Energy bin boundaries: 0.00E+00 ' +
+                    ' '.join('{:.2E}'.format(e) for e in ebins) + '\n\n')
+            if ne > 1:
+                f.write('   Energy         X         Y         Z     Result'
+                        '     Rel Error\n')
+                blocks = ['{:11.3E}'.format(e) for e in ebins] + ['   Total   ']
+            else:
+                f.write('        X         Y         Z     Result'
+                        '     Rel Error\n')
+                blocks = ['']
+            fmt = ' %9.3f %9.3f %9.3f %11.5E %11.5E\n'
+            for prefix in blocks:
+                for s in range(0, n, CHUNK):
+                    ijk = _cell_indices(ni, nj, nk, s, min(s + CHUNK, n))
+                    c = column_stack((x[ijk[:, 0] - 1], y[ijk[:, 1] - 1],
+                                      z[ijk[:, 2] - 1])) + 0.5
+                    r = column_stack((c, random.random((len(c), 2))))
+                    _write_lines(f, prefix + fmt, r)
+            f.write('\n')
+
+
+def dgs(fname, ni, nj, nk, ng=24):
+    """
+    Write dgs file on the (ni, nj, nk) mesh, with `ng` energy groups. All
+    mesh elements are activated.
+    """
+    n = ni * nj * nk
+    with open(fname, 'w') as f:
+        f.write('{} {} {}\n'.format(ni + 1, nj + 1, nk + 1))
+        for b in (_bounds(ni), _bounds(nj), _bounds(nk)):
+            f.write(' '.join('%.5e' % v for v in b) + '\n')
+        f.write('{}\n'.format(n))
+        fmt = '1 %d %d %d' + ' %.5e' * ng + '\n'
+        for s in range(0, n, CHUNK):
+            ijk = _cell_indices(ni, nj, nk, s, min(s + CHUNK, n))
+            r = column_stack((ijk, random.random((len(ijk), ng))))
+            _write_lines(f, fmt, r)
+
+
+def dgs_old(fname, ni, nj, nk, ng=24):
+    """
+    Write dgs file in the old format on the (ni, nj, nk) mesh, with `ng`
+    energy groups.
+    """
+    n = ni * nj * nk
+    with open(fname, 'w') as f:
+        f.write('0 {0} {0} 0 {1} {1} 0 {2} {2} x x {3}\n'.format(ni, nj, nk, n))
+        fmt = '%.1f %.1f %.1f' + ' %.5e' * ng + '\n'
+        for s in range(0, n, CHUNK):
+            ijk = _cell_indices(ni, nj, nk, s, min(s + CHUNK, n))
+            r = column_stack((ijk - 1, random.random((len(ijk), ng))))
+            _write_lines(f, fmt, r)
+
+
+def fmc(fname, ni, nj, nk, maxnc=3):
+    """
+    Write fine mesh content file on the (ni, nj, nk) mesh. Mesh elements
+    contain 1 to `maxnc` cells, material 0 denotes void.
+    """
+    n = ni * nj * nk
+    with open(fname, 'w') as f:
+        f.write('{} {} {}\n'.format(ni + 1, nj + 1, nk + 1))
+        for b in (_bounds(ni), _bounds(nj), _bounds(nk)):
+            f.write(' '.join('%.5e' % v for v in b) + '\n')
+        f.write('{}\n'.format(n))
+        for s in range(0, n, CHUNK):
+            ijk = _cell_indices(ni, nj, nk, s, min(s + CHUNK, n))
+            ncl = random.randint(1, maxnc + 1, len(ijk))
+            # records with the same number of cells are formatted together
+            for nc in range(1, maxnc + 1):
+                m = ncl == nc
+                hits = random.randint(1, 100, (m.sum(), nc))
+                cells = repeat(arange(nc)[None, :] + 10, m.sum(), axis=0)
+                mats = random.randint(0, 3, (m.sum(), nc))
+                trip = dstack((cells, hits, mats)).reshape(-1, 3*nc)
+                r = column_stack((ijk[m], 0*ijk[m], repeat(nc, m.sum()),
+                                  hits.sum(axis=1), trip))
+                _write_lines(f, '%d ' * (8 + 3*nc) + '\n', r)
+
+
+generators = {'meshtal': meshtal, 'dgs': dgs, 'dgs.old': dgs_old, 'fmc': fmc}
+
+
+if __name__ == '__main__':
+    from sys import argv
+    kind, args, fname = argv[1], map(int, argv[2:-1]), argv[-1]
+    generators[kind](fname, *args)
@@ -0,0 +1,217 @@
+# Benchmarks of tovtk readers and writers
+"""
+Times reading and writing stages of tovtk on synthetic input files written by
+generate.py. Each stage runs in a separate process, so that the peak resident
+set size (RSS) is measured for this stage only.
+
+Usage:
+
+    >python run.py [options]
+
+Options:
+
+    --shape NI NJ NK    Number of mesh elements in each direction (100 100 100)
+    --ebins NE          Number of energy bins in meshtallies (1)
+    --tallies NT        Number of meshtallies in the meshtal file (1)
+    --groups NG         Number of energy groups in dgs files (24)
+    --stages S1,S2,...  Stages to run (all), see STAGES
+    --repeat R          Number of runs of each stage (1)
+    --dir D             Directory for generated files (data)
+    --out F             Results file (results.jsonl)
+
+    --compare F1 F2     Compare results from two files and exit
+
+Input files are generated once and reused while the parameters remain the
+same. Results are appended to the results file as JSON objects, one per line,
+with the git commit of the benchmarked tree, so that runs on different
+commits can be compared with the --compare option.
+"""
+import os
+import sys
+import json
+import time
+import resource
+import subprocess
+
+# Benchmarks run on the tovtk package in this tree
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STAGES = ['read_meshtal', 'readdgs', 'readdgs_old', 'read_vol_frac',
+          'rectangular', 'rectangular_vtk']
+
+
+def _usage():
+    """
+    Returns (wall time, cpu time, peak RSS in kB) of the current process.
+    """
+    r = resource.getrusage(resource.RUSAGE_SELF)
+    return time.time(), r.ru_utime + r.ru_stime, r.ru_maxrss
+
+
+def run_stage(stage, fname, shape):
+    """
+    Run stage in the current process. Returns dictionary with timings.
+    """
+    sys.path.insert(0, _root)
+    from numpy import random, arange
+    if stage == 'read_meshtal':
+        from tovtk.tallies import read_meshtal
+        func = lambda: read_meshtal(fname, use_uncertainties=False)
+    elif stage == 'readdgs':
+        from tovtk.dgs import readdgs
+        func = lambda: readdgs(fname)
+    elif stage == 'readdgs_old':
+        from tovtk.dgs import readdgs_old
+        func = lambda: readdgs_old(fname)
+    elif stage == 'read_vol_frac':
+        from tovtk.fmc import read_vol_frac
+        func = lambda: read_vol_frac(fname)
+    elif stage.startswith('rectangular'):
+        from tovtk.main import rectangular
+        writer = 'vtk' if stage == 'rectangular_vtk' else 'numpy'
+        x, y, z = [arange(n + 1, dtype=float) for n in shape]
+        vals = random.random(shape)
+        errs = random.random(shape)
+        func = lambda: rectangular(fname, x, y, z, vals, errs, writer=writer)
+    else:
+        raise ValueError('Unknown stage ', stage)
+    t0, c0, m0 = _usage()
+    func()
+    t1, c1, m1 = _usage()
+    return {'wall': t1 - t0, 'cpu': c1 - c0, 'rss_start_kb': m0,
+            'maxrss_kb': m1}
+
+
+def _commit():
+    """
+    Returns the current git commit of the tree, or None.
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=_root).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _input(stage, dname, shape, ne, nt, ng):
+    """
+    Returns name of the input (or output) file for `stage`. Input files are
+    generated, if they do not exist.
+    """
+    import generate
+    s = '{}x{}x{}'.format(*shape)
+    if stage == 'read_meshtal':
+        fname, gen = 'm{}_e{}_t{}.meshtal'.format(s, ne, nt), (
+            generate.meshtal, shape + [ne, nt])
+    elif stage == 'readdgs':
+        fname, gen = 'd{}_g{}.dgs'.format(s, ng), (generate.dgs, shape + [ng])
+    elif stage == 'readdgs_old':
+        fname, gen = 'd{}_g{}.dgsold'.format(s, ng), (
+            generate.dgs_old, shape + [ng])
+    elif stage == 'read_vol_frac':
+        fname, gen = 'f{}.fmc'.format(s), (generate.fmc, shape)
+    else:
+        return os.path.join(dname, 'w{}_{}.vtr'.format(s, stage))
+    fname = os.path.join(dname, fname)
+    if not os.path.exists(fname):
+        print 'Generating', fname
+        gen[0](fname + '.tmp', *gen[1])
+        os.rename(fname + '.tmp', fname)
+    return fname
+
+
+def compare(f1, f2):
+    """
+    Print ratio of the best wall times from results files `f1` and `f2`.
+    """
+    best = []
+    for fname in (f1, f2):
+        d = {}
+        for l in open(fname):
+            r = json.loads(l)
+            key = (r['stage'], tuple(r['shape']), r['ebins'], r['tallies'],
+                   r['groups'])
+            d[key] = min(d.get(key, r['wall']), r['wall'])
+        best.append(d)
+    print '{:16s} {:>16s} {:>10s} {:>10s} {:>7s}'.format(
+        'stage', 'shape', f1[-10:], f2[-10:], 'ratio')
+    for key in sorted(set(best[0]) & set(best[1])):
+        t1, t2 = best[0][key], best[1][key]
+        print '{:16s} {:>16s} {:10.3f} {:10.3f} {:7.2f}'.format(
+            key[0], 'x'.join(map(str, key[1])), t1, t2, t2 / t1)
+
+
+def main(args):
+    if args[:1] == ['--stage']:
+        # child process
+        stage, fname = args[1:3]
+        shape = map(int, args[3:6])
+        print json.dumps(run_stage(stage, fname, shape))
+        return 0
+    if args[:1] == ['--compare']:
+        compare(*args[1:3])
+        return 0
+
+    shape = [100, 100, 100]
+    ne, nt, ng = 1, 1, 24
+    stages = STAGES
+    repeat = 1
+    dname = 'data'
+    out = 'results.jsonl'
+    while args:
+        o = args.pop(0)
+        if o == '--shape':
+            shape = map(int, args[:3])
+            args = args[3:]
+        elif o == '--ebins':
+            ne = int(args.pop(0))
+        elif o == '--tallies':
+            nt = int(args.pop(0))
+        elif o == '--groups':
+            ng = int(args.pop(0))
+        elif o == '--stages':
+            stages = args.pop(0).split(',')
+        elif o == '--repeat':
+            repeat = int(args.pop(0))
+        elif o == '--dir':
+            dname = args.pop(0)
+        elif o == '--out':
+            out = args.pop(0)
+        else:
+            print __doc__
+            return 2
+    if not os.path.isdir(dname):
+        os.makedirs(dname)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    info = {'commit': _commit(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': sys.version.split()[0],
+            'shape': shape, 'ebins': ne, 'tallies': nt, 'groups': ng}
+    print '{:16s} {:>10s} {:>10s} {:>12s} {:>12s}'.format(
+        'stage', 'wall, s', 'cpu, s', 'peak RSS, MB', 'file, MB')
+    for stage in stages:
+        fname = _input(stage, dname, shape, ne, nt, ng)
+        for r in range(repeat):
+            p = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                                  '--stage', stage, fname] + map(str, shape),
+                                 stdout=subprocess.PIPE)
+            o = p.communicate()[0]
+            if p.returncode != 0:
+                print 'Stage {} failed'.format(stage)
+                continue
+            res = dict(info)
+            res.update(json.loads(o.splitlines()[-1]))
+            res['stage'] = stage
+            res['file'] = os.path.basename(fname)
+            res['bytes'] = os.path.getsize(fname)
+            with open(out, 'a') as f:
+                f.write(json.dumps(res, sort_keys=True) + '\n')
+            print '{:16s} {:10.3f} {:10.3f} {:12.1f} {:12.1f}'.format(
+                stage, res['wall'], res['cpu'], res['maxrss_kb'] / 1024.,
+                res['bytes'] / 2.**20)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,130 @@
+# Binary cache of data parsed from input files
+"""
+The data read from file `fname` is stored in the cache file `fname`.cache.
+It contains a text header followed by raw arrays, which are memory-mapped
+when the cache is loaded.
+
+The cache is valid while size, modification time and the hash of the
+beginning of `fname` remain unchanged, see cache_stamp().
+"""
+import os
+from hashlib import sha1
+from ast import literal_eval
+from numpy import memmap, ascontiguousarray, empty
+
+_VERSION = 'tovtk cache 2'
+
+# Number of bytes at the beginning of the input file used for the hash
+_HEAD_SIZE = 2**16
+
+# Arrays in the cache file start at multiples of _ALIGN bytes
+_ALIGN = 64
+
+
+def _pad(n):
+    """
+    Returns n rounded up to the multiple of _ALIGN.
+    """
+    return (n + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+def cache_name(fname):
+    return fname + '.cache'
+
+
+def cache_stamp(fname, kind):
+    """
+    Returns tuple identifying the content of file `fname` read as `kind`
+    ('meshtal', 'dgs', etc.)
+    """
+    st = os.stat(fname)
+    with open(fname, 'rb') as f:
+        h = sha1(f.read(_HEAD_SIZE)).hexdigest()
+    return (kind, st.st_size, repr(st.st_mtime), h)
+
+
+def load_cache(fname, stamp):
+    """
+    Returns tuple (meta, arrays) from the cache of file `fname`, or None if
+    there is no cache or it does not correspond to `stamp`.
+
+    `meta` is an object of basic Python types, `arrays` is a dictionary of
+    memory-mapped arrays. Changing the arrays does not change the cache file.
+    """
+    cname = cache_name(fname)
+    if not os.path.exists(cname):
+        return None
+    with open(cname, 'rb') as f:
+        if f.readline().strip() != _VERSION:
+            return None
+        header = literal_eval(f.readline())
+        start = _pad(f.tell())
+    if header['stamp'] != stamp:
+        return None
+    arrays = {}
+    for name, dt, shape, offset in header['arrays']:
+        if 0 in shape:
+            arrays[name] = empty(shape, dtype=dt)
+        else:
+            arrays[name] = memmap(cname, dtype=dt, mode='c',
+                                  offset=start + offset, shape=shape)
+    return header['meta'], arrays
+
+
+def save_cache(fname, stamp, meta, arrays):
+    """
+    Write cache of file `fname`.
+
+    `stamp` is the result of cache_stamp() obtained before `fname` was read.
+    `meta` is an object of basic Python types (int, float, str, list, tuple,
+    dict), `arrays` is a dictionary of numpy arrays.
+
+    Returns True if the cache file is written.
+    """
+    cname = cache_name(fname)
+    alist = []
+    offset = 0
+    for name in sorted(arrays.keys()):
+        a = ascontiguousarray(arrays[name])
+        alist.append((name, a.dtype.str, a.shape, offset))
+        offset += _pad(a.nbytes)
+    header = {'stamp': stamp, 'meta': meta, 'arrays': alist}
+    try:
+        # write to a temporary file first, so that an incomplete cache file
+        # is never used
+        with open(cname + '.tmp', 'wb') as f:
+            f.write(_VERSION + '\n')
+            f.write(repr(header) + '\n')
+            f.write('\0' * (_pad(f.tell()) - f.tell()))
+            for name, dt, shape, offset in alist:
+                a = ascontiguousarray(arrays[name])
+                a.tofile(f)
+                f.write('\0' * (_pad(a.nbytes) - a.nbytes))
+        os.rename(cname + '.tmp', cname)
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def cached_grid(reader, fname, kind):
+    """
+    Returns (x, y, z, a, ...) as read from file `fname` by function `reader`,
+    using the cache of `fname`.
+
+    This is used for dgs and fmc files, whose readers return lists of boundary
+    coordinates x, y, z followed by one or more arrays of values.
+    """
+    stamp = cache_stamp(fname, kind)
+    c = load_cache(fname, stamp)
+    if c is not None:
+        meta, arrays = c
+        return tuple([arrays['x'].tolist(), arrays['y'].tolist(),
+                      arrays['z'].tolist()] +
+                     [arrays[n] for n in meta['names']])
+    res = reader(fname)
+    x, y, z = res[:3]
+    names = ['a'] + ['a{}'.format(i) for i in range(1, len(res) - 3)]
+    arrays = dict(zip(names, res[3:]))
+    arrays.update({'x': x, 'y': y, 'z': z})
+    save_cache(fname, stamp, {'names': names}, arrays)
+    return res
@@ -0,0 +1,160 @@
+# Derived arrays computed from meshtallies at conversion time
+"""
+Expressions like `(t4 + t24) * Ch` combine "total" results of meshtallies on
+the same mesh (`tN` is meshtally N) with numbers and named constants. They
+are evaluated with numpy arrays, and statistical errors are propagated to
+the first order, assuming that results of different meshtallies are
+independent (each meshtally should appear in an expression once).
+
+Only numbers, names, parentheses, unary minus and operators +, -, *, / are
+allowed in expressions.
+"""
+import ast
+import re
+from numpy import asarray, sqrt, where, errstate, float64
+
+# Names of meshtallies in expressions
+_tally_name = re.compile(r'^t(\d+)$')
+
+
+class Quantity(object):
+    """
+    Array of values with variances, i.e. squared absolute errors.
+    """
+    def __init__(self, val, var):
+        self.val = val
+        self.var = var
+
+    @classmethod
+    def from_relative(cls, val, rerr):
+        """
+        Returns Quantity with values `val` and relative errors `rerr`.
+        """
+        val = asarray(val, dtype=float)
+        return cls(val, (val * rerr)**2)
+
+    @property
+    def rerr(self):
+        """
+        Array of relative errors, zero where the value is zero.
+        """
+        v = where(self.val != 0.0, self.val, 1.0)
+        with errstate(divide='ignore', invalid='ignore'):
+            return where(self.val != 0.0, sqrt(self.var) / abs(v), 0.0)
+
+    def __neg__(self):
+        return Quantity(-self.val, self.var)
+
+    def __add__(self, other):
+        if isinstance(other, Quantity):
+            return Quantity(self.val + other.val, self.var + other.var)
+        return Quantity(self.val + other, self.var)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        return self + (-other)
+
+    def __rsub__(self, other):
+        return (-self) + other
+
+    def __mul__(self, other):
+        if isinstance(other, Quantity):
+            return Quantity(self.val * other.val,
+                            self.var * other.val**2 + other.var * self.val**2)
+        return Quantity(self.val * other, self.var * other**2)
+
+    __rmul__ = __mul__
+
+    def __div__(self, other):
+        if isinstance(other, Quantity):
+            r = self.val / other.val
+            return Quantity(r, (self.var + other.var * r**2) / other.val**2)
+        return Quantity(self.val / other, self.var / other**2)
+
+    def __rdiv__(self, other):
+        r = other / self.val
+        return Quantity(r, self.var * r**2 / self.val**2)
+
+    __truediv__ = __div__
+    __rtruediv__ = __rdiv__
+
+
+_operators = {ast.Add: lambda a, b: a + b,
+              ast.Sub: lambda a, b: a - b,
+              ast.Mult: lambda a, b: a * b,
+              ast.Div: lambda a, b: a / b}
+
+
+def _parse(expr):
+    """
+    Returns the body of the parsed expression `expr`. ValueError is raised
+    for syntax errors.
+    """
+    try:
+        return ast.parse(expr.strip(), mode='eval').body
+    except SyntaxError:
+        raise ValueError('Wrong expression ', expr)
+
+
+def names(expr):
+    """
+    Returns the list of names in expression `expr`, in order of appearance.
+    """
+    res = []
+    for node in ast.walk(_parse(expr)):
+        if isinstance(node, ast.Name) and node.id not in res:
+            res.append(node.id)
+    return res
+
+
+def tallies(expr):
+    """
+    Returns the list of numbers of meshtallies in expression `expr`.
+    """
+    res = []
+    for n in names(expr):
+        m = _tally_name.match(n)
+        if m:
+            res.append(int(m.group(1)))
+    return res
+
+
+def evaluate(expr, variables):
+    """
+    Returns the value of expression `expr`. Names in the expression are
+    looked up in the dictionary `variables` with numbers or Quantity
+    objects. Division by zero gives inf or nan values without warnings.
+    """
+    # numbers are numpy scalars, so that errstate applies to them as well
+    def ev(node):
+        if isinstance(node, ast.Num):
+            return float64(node.n)
+        elif isinstance(node, ast.Name):
+            if node.id not in variables:
+                raise ValueError('Unknown name {} in expression {}'.format(
+                                 node.id, expr))
+            v = variables[node.id]
+            return v if isinstance(v, Quantity) else float64(v)
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            return -ev(node.operand)
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.UAdd):
+            return ev(node.operand)
+        elif isinstance(node, ast.BinOp) and type(node.op) in _operators:
+            return _operators[type(node.op)](ev(node.left), ev(node.right))
+        raise ValueError('Not allowed in expression ', expr)
+    with errstate(divide='ignore', invalid='ignore'):
+        return ev(_parse(expr))
+
+
+def definition(s):
+    """
+    Returns (name, expression) from the string `s` of the form
+    `name=expression`.
+    """
+    name, sep, expr = s.partition('=')
+    name = name.strip()
+    if not sep or not re.match(r'^[A-Za-z_]\w*$', name):
+        raise ValueError('Wrong definition, name=expression expected ', s)
+    _parse(expr)
+    return name, expr.strip()
@@ -1,9 +1,52 @@
 # Operations with dgs files
-from numpy import zeros
-from tqdm import tqdm
+from numpy import zeros, fromstring, array, floor, nonzero
+from .cache import cached_grid
 
+# Approximate number of bytes read and parsed at once
+_CHUNK_SIZE = 2**20
 
-def readdgs(fname):
+
+def _row_chunks(f, n):
+    """
+    Generator of (i, a) tuples with arrays `a` of the shape (m, ncol) with
+    data lines i to i+m-1 of the next `n` lines of file `f`, about
+    _CHUNK_SIZE bytes at a time. All lines must have the same number of
+    values as the first one.
+    """
+    pos = f.tell()
+    ncol = len(f.readline().split())
+    f.seek(pos)
+    i = 0
+    while i < n:
+        lines = f.readlines(_CHUNK_SIZE)[:n - i]
+        if not lines:
+            raise ValueError('Unexpected end of file ', f.name, n, i)
+        r = fromstring(''.join(lines), sep=' ')
+        if r.size != len(lines) * ncol:
+            for l, line in enumerate(lines):
+                if len(line.split()) != ncol:
+                    break
+            raise ValueError('Wrong number of values in data line ', i + l + 1,
+                             line, ncol)
+        yield i, r.reshape(len(lines), ncol)
+        i += len(lines)
+
+
+def readdgs(fname, cache=False, spectrum=False):
+    """
+    Read dgs file `fname`. Returns lists of boundary coordinates x, y, z and
+    array of gamma intensities summed over energy groups.
+
+    When `spectrum` is True, the array of the shape (ni, nj, nk, ng) with
+    intensities in energy groups is returned as the 5-th element.
+
+    When `cache` is True, the binary cache of `fname` is used.
+    """
+    if cache:
+        if spectrum:
+            return cached_grid(lambda n: readdgs(n, spectrum=True), fname,
+                               'dgs+spectrum')
+        return cached_grid(readdgs, fname, 'dgs')
     with open(fname) as f:
         # read header
         ni, nj, nk = map(int, f.readline().split())
@@ -11,13 +54,21 @@ def readdgs(fname):
         y = map(float, f.readline().split())
         z = map(float, f.readline().split())
         ne = int(f.readline())
-        # read data
+        # read data. Columns are ti, i, j, k and intensities in energy groups.
+        # Each chunk of lines is put to the mesh arrays as it is read.
         a = zeros((ni - 1, nj - 1, nk - 1))
-        for k in tqdm(range(ne)):
-            vals = f.readline().split()
-            ti, i, j, k = map(int, vals[0:4])
-            vals = map(float, vals[4:])
-            a[i - 1, j - 1, k - 1] = sum(vals)
+        s = None
+        for n, d in _row_chunks(f, ne):
+            i, j, k = d[:, 1:4].astype(int).T - 1
+            a[i, j, k] = d[:, 4:].sum(axis=1)
+            if spectrum:
+                if s is None:
+                    s = zeros(a.shape + (d.shape[1] - 4, ))
+                s[i, j, k] = d[:, 4:]
+        if spectrum:
+            if s is None:
+                s = zeros(a.shape + (0, ))
+            return x, y, z, a, s
         return x, y, z, a
 
 
@@ -48,7 +99,15 @@ def c_to_i(xmin, xmax, N, x):
     return int(ii)
 
 
-def readdgs_old(fname):
+def readdgs_old(fname, cache=False):
+    """
+    Read dgs file `fname` in the old format. Returns lists of boundary
+    coordinates x, y, z and array of gamma intensities.
+
+    When `cache` is True, the binary cache of `fname` is used.
+    """
+    if cache:
+        return cached_grid(readdgs_old, fname, 'dgs.old')
     with open(fname) as f:
         # read header
         tokens = f.readline().split()
@@ -66,21 +125,37 @@ def readdgs_old(fname):
         y = map(lambda i: ymin + i*dy, range(yn+1))
         z = map(lambda i: zmin + i*dz, range(zn+1))
 
-        # read data
+        # read data. Columns are coordinates of the mesh element lower corner
+        # and intensities in energy groups. Each chunk of lines is put to the
+        # mesh array as it is read.
         a = zeros((xn, yn, zn))
-        for k in tqdm(range(n)):
-            vals = f.readline().split()
-            xi, yi, zi = map(float, vals[0:3])
-            i = c_to_i(xmin, xmax, xn, xi)
-            j = c_to_i(ymin, ymax, yn, yi)
-            k = c_to_i(zmin, zmax, zn, zi)
-
-            # check coordinate to index conversion
-            assert abs(xi - x[i]) < 0.01
-            assert abs(yi - y[j]) < 0.01
-            assert abs(zi - z[k]) < 0.01
-            vals = map(float, vals[3:])
-            a[i, j, k] = sum(vals) * dv
+        bounds = [array(b) for b in (x, y, z)]
+        # number of lines with wrong coordinates and the first of them
+        nbad = 0
+        badrows = []
+        for m, d in _row_chunks(f, n):
+            ijk = []
+            bad = zeros(len(d), dtype=bool)
+            for (c, cmin, dc, cn, b) in zip(d[:, 0:3].T, (xmin, ymin, zmin),
+                                            (dx, dy, dz), (xn, yn, zn),
+                                            bounds):
+                i = floor((c - cmin) / dc).astype(int)
+                out = (i < 0) | (i >= cn)
+                i[out] = 0
+                # check coordinate to index conversion
+                bad |= out | (abs(c - b[i]) >= 0.01)
+                ijk.append(i)
+            if bad.any():
+                rows = nonzero(bad)[0]
+                nbad += len(rows)
+                badrows.extend((m + r + 2, d[r, 0:3]) for r in rows[:10])
+                continue
+            a[tuple(ijk)] = d[:, 3:].sum(axis=1) * dv
+        if nbad > 0:
+            print 'Coordinates do not correspond to mesh boundaries in lines:'
+            for l, c in badrows[:10]:
+                print l, c
+            raise ValueError('Wrong coordinates in data lines ', fname, nbad)
 
         return x, y, z, a
 
@@ -1,6 +1,10 @@
 # fine mesh content reader
-from numpy import zeros
-from tqdm import tqdm
+from numpy import (zeros, frombuffer, fromstring, uint8, nonzero, cumsum,
+                   concatenate, repeat, arange, add, diff, searchsorted)
+from .cache import cached_grid
+
+# Approximate number of bytes read and parsed at once
+_CHUNK_SIZE = 2**20
 
 
 def fmc_iterator(fname):
@@ -21,37 +25,115 @@ def fmc_iterator(fname):
             yield f.readline()
 
 
-def read_vol_frac(fname):
+def _record_lengths(buf, n):
+    """
+    Returns array with the number of whitespace-separated tokens in each of
+    the first `n` lines of string `buf`, and the length of these lines.
+    """
+    b = frombuffer(buf, dtype=uint8)
+    ws = (b == ord(' ')) | (b == ord('\t')) | (b == ord('\n')) | (b == ord('\r'))
+    # token starts: non-whitespace character after whitespace
+    starts = ~ws
+    starts[1:] &= ws[:-1]
+    ts = nonzero(starts)[0]
+    del ws, starts
+    eol = nonzero(b == ord('\n'))[0]
+    if len(eol) < n:
+        raise ValueError('Unexpected end of file, lines expected ', n, len(eol))
+    eol = eol[:n]
+    ntok = diff(concatenate(([0], searchsorted(ts, eol, 'right'))))
+    return ntok, eol[-1] + 1
+
+
+def _records(buf, n, fname):
+    """
+    Returns (i, j, k, vf, bad) for `n` records in string `buf`: 0-based
+    indices of mesh elements, their material volume fractions and the
+    boolean array marking inconsistent records.
+    """
+    if not buf.endswith('\n'):
+        buf += '\n'
+    # Records are i, j, k, three values not used here, number of cells nc,
+    # number of samples nh and (cell, hits, material) for each cell. All
+    # records are tokenized to one flat array, each record starts at offset.
+    ntok, end = _record_lengths(buf, n)
+    t = fromstring(buf[:end], sep=' ')
+    del buf
+    if t.size != ntok.sum():
+        raise ValueError('Non-numeric data in file ', fname)
+    t = t.astype(int)
+    offset = concatenate(([0], cumsum(ntok)[:-1]))
+    i, j, k = [t[offset + c] - 1 for c in range(3)]
+    nc = t[offset + 6]
+    nh = t[offset + 7]
+    # cells of records with wrong length are not used
+    bad = (ntok != 8 + 3*nc) | (nh <= 0)
+    nc[bad] = 0
+    nh[bad] = 1
+
+    # hits and material indices of all cells in all records
+    first = concatenate(([0], cumsum(nc)[:-1]))   # first cell of each record
+    ic = arange(nc.sum()) - repeat(first, nc)     # cell index in its record
+    pos = repeat(offset + 8, nc) + 3 * ic
+    hl = t[pos + 1]
+    ml = t[pos + 2]
+
+    # Segmented sums over cells of each record
+    s1 = zeros(n, dtype=int)  # hits in all cells, for check only
+    s2 = zeros(n, dtype=int)  # hits in non-void cells
+    nv = zeros(n, dtype=int)  # number of void cells
+    full = nc > 0
+    if full.any():
+        s1[full] = add.reduceat(hl, first[full])
+        s2[full] = add.reduceat(hl * (ml != 0), first[full])
+        nv[full] = add.reduceat((ml == 0).astype(int), first[full])
+
+    bad |= s1 != nh
+    bad |= (nv > 0) & (s2 >= nh)
+    bad |= (nv == 0) & (s2 != nh)
+    return i, j, k, s2 / nh.astype(float), bad
+
+
+def read_vol_frac(fname, cache=False):
     """
     This is the file with header, exactly as dgs.
 
     Compute vol. frac. of materials in each fine mesh element.
+
+    When `cache` is True, the binary cache of `fname` is used.
     """
-    fmci = fmc_iterator(fname)
-    x, y, z, ne, a = fmci.next()
-    for k in tqdm(range(ne)):
-        vals = fmci.next().split()
-        i, j, k = map(int, vals[0:3])
-        vals = map(int, vals[6:])
-        # cell indices
-        nc = vals[0]  # number of cells detected
-        nh = vals[1]  # number of samples
-        # cl = vals[2::3]  # cell indices
-        hl = vals[3::3]  # hits in each cell
-        ml = vals[4::3]  # material index in the cell
-
-        # Hits in all non-void cells
-        s1 = 0  # hits in all cells, for check only
-        s2 = 0  # hits in non-void cells
-        for ic in range(nc):
-            s1 += hl[ic]
-            if ml[ic] != 0:
-                s2 += hl[ic]
-        assert s1 == nh
-        if 0 in ml:
-            assert s2 < nh
-        else:
-            assert s2 == nh
-
-        a[i - 1, j - 1, k - 1] = float(s2) / float(nh)
+    if cache:
+        return cached_grid(read_vol_frac, fname, 'fmc')
+    with open(fname) as f:
+        # read header
+        ni, nj, nk = map(int, f.readline().split())
+        x = map(float, f.readline().split())
+        y = map(float, f.readline().split())
+        z = map(float, f.readline().split())
+        ne = int(f.readline())
+        a = zeros((ni - 1, nj - 1, nk - 1))
+        # Records are read in chunks of lines. Inconsistent records are
+        # counted, the first of them reported at the end.
+        nbad = 0
+        badcells = []
+        n = 0
+        while n < ne:
+            lines = f.readlines(_CHUNK_SIZE)[:ne - n]
+            if not lines:
+                raise ValueError('Unexpected end of file, lines expected ',
+                                 ne, n)
+            i, j, k, vf, bad = _records(''.join(lines), len(lines), fname)
+            n += len(lines)
+            good = ~bad
+            a[i[good], j[good], k[good]] = vf[good]
+            if bad.any():
+                rows = nonzero(bad)[0]
+                nbad += len(rows)
+                badcells.extend(zip(i[rows[:10]] + 1, j[rows[:10]] + 1,
+                                    k[rows[:10]] + 1))
+    if nbad > 0:
+        print 'Inconsistent records for mesh elements:'
+        for c in badcells[:10]:
+            print '{} {} {}'.format(*c)
+        raise ValueError('Inconsistent records in fmc file ', fname, nbad)
     return x, y, z, a
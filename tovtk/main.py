@@ -1,13 +1,14 @@
 #!/usr/bin/env python
 
-from sys import argv
-import vtk
-from numpy import array, reshape, amax, amin
-from .tallies import read_meshtal
-from .dgs import readdgs, readdgs_old
-from .fmc import read_vol_frac
+import os
+from sys import argv, exit
 
-_vtkVersion = vtk.vtkVersion.GetVTKSourceVersion().split()[-1]
+# Modules numpy, vtk, etc. are imported in functions where they are needed.
+# This keeps startup of the command line tool fast, e.g. when only the help
+# message is printed.
+
+# Availability of the vtk package, checked on the first use.
+_vtk_package = None
 
 help_note = """
 Meshtal to VTK converter.
@@ -16,10 +17,110 @@ Converts rectangular meshtallies from meshtal files given in the command line.
 Each meshtally is written to a separate vtr file representing a rectilinear
 grid. Invocation:
 
-    >tovtk  meshtal1 [meshtal2 ...]
+    >tovtk [-j N] [-e BINS] [--ecomp] [--cache] [--writer W] [--pieces P]
+          [--encoding E] [--compressor C[:L]] [--block-size B] [--float32]
+          [--stream MB] [--merge OUT] [--series NAME[:index]] [--watch S]
+          [--scale N=C] [--derive NAME=EXPR] [--zerovf W] [--stats]
+          [--stats-json F] meshtal1 [...]
 
 For each meshtally `N` in file `meshtal`, script writes a vtk file named
-`meshtal_tN.vtr`.  """
+`meshtal_tN.vtr`.
+
+Option `-j N` distributes reading and writing of meshtallies over N worker
+processes. The exit status is non-zero if some of the files could not be
+written or some arrays (see --derive below) could not be derived.
+
+By default, only the "total" energy bin is written as arrays `val` and `err`.
+Option `-e BINS` adds arrays for energy bins. BINS is a comma-separated list
+of 1-based bin indices, ranges `n:m` meaning the sum over bins n to m, or
+`all` for every energy bin. Option `-e` can be repeated. Each entry is written
+to arrays `val_eN`, `err_eN` (or `val_eN-M`, `err_eN-M` for sums); with
+option `--ecomp`, all entries are written to the multi-component arrays
+`val_e` and `err_e`.
+
+Option `--cache` stores data read from the input files in binary cache files
+`meshtal.cache` (or `dgs.cache`, etc.), and reads the data from them while
+the input files remain unchanged. With `-j N` or `--merge`, a missing or
+outdated cache of a meshtal file is written before meshtallies are read.
+
+Option `--writer W` chooses how vtr files are written: `vtk` uses the VTK
+library, `numpy` writes files of the same format without VTK. By default,
+`vtk` is used if the vtk package can be imported.
+
+Option `--pieces P` splits grids into pieces written concurrently to files
+`meshtal_tN_0.vtr`, `meshtal_tN_1.vtr`, etc. and the parallel file
+`meshtal_tN.pvtr` referring to them, e.g. for a parallel Paraview server.
+P is either the number of pieces along the axis with the most mesh elements,
+or the comma-separated numbers of pieces along x, y and z, e.g. `2,2,1`; all
+numbers are at least 1. The description of the meshtally is written only to
+the pieces, Paraview does not show it for the .pvtr file.
+
+Options `--encoding`, `--compressor` and `--block-size` control how arrays
+are stored in vtr files. Encoding E is `base64` (default) or `raw`; raw files
+are about 25% smaller and faster to write and read, but are not valid XML
+text. Compressor C is `zlib` (default), `lz4`, `lzma` or `none`, optionally
+with the compression level L from 1 to 9, e.g. `zlib:1` or `lzma:9`. LZ4 is
+fast with moderate compression, LZMA compresses best but slowest; both
+require the corresponding Python packages for the numpy writer and VTK 8.2
+for lzma. When the VTK writer does not support the compressor, files are
+written with the numpy writer. Arrays are compressed in blocks of B > 0
+bytes (32768 by default).
+
+Option `--float32` writes cell data in single precision (coordinates remain
+in double precision), which halves the size of files and the memory needed
+in Paraview. Results in meshtal files have 6 significant digits, well within
+the float32 precision. The number of values outside of the float32 range
+(absolute values below about 1.2e-38 or above 3.4e38) is reported.
+
+Option `--stream MB` converts meshtal files larger than the available memory:
+tables with results are read in chunks of MB megabytes and the "total" energy
+bin is written through temporary files next to the output files. Options -e,
+-j and --pieces are not used in this mode, vtr files are written without VTK.
+
+Option `--merge OUT` combines meshtal files from independent runs of the same
+problem (e.g. with different random number seeds) into files `OUT_tN.vtr`.
+Values of each meshtally are averaged with the numbers of histories of the
+runs as weights, relative errors are those of the weighted mean, and the
+description gives the total number of histories. Only meshtallies present in
+all files are written. Files are read one at a time, so memory use does not
+depend on their number. Options -j and --stream are not used in this mode.
+With `--cache`, missing or outdated caches of the files are written first.
+
+Option `--series NAME` treats meshtal files as successive steps, e.g.
+snapshots from restart runs. Besides the vtr files of each step, it writes
+the collection files `NAME_tN.pvd`, opened by Paraview as time series, with
+the number of histories as the timestep value (`NAME:index` uses the index of
+the file in the command line instead). The mesh of each meshtally is checked
+once and its coordinate arrays are shared by all steps. Outputs not older
+than their meshtal file are not written again.
+
+Option `--watch S` follows meshtal files written by a running MCNP job. The
+files are checked every S seconds; after a file has changed and remained
+unchanged for S seconds, only meshtallies whose blocks in the file have
+changed are read and written again. Stop with Ctrl-C. Options -j and
+--stream are not used in this mode.
+
+Option `--scale N=C` multiplies values of meshtally N by C, a number or
+constant Ch or Cf (see below), e.g. `--scale 4=Ch`. Option `--derive
+NAME=EXPR` writes arrays NAME and NAME_err (relative error) computed by the
+expression EXPR from the "total" bins of meshtallies on the same mesh, e.g.
+`--derive 'heat=(t4 + t24) * Ch'`. Expressions contain meshtallies `tN`,
+numbers, Ch, Cf, parentheses and operators +, -, *, /; tallies in them are
+not scaled by --scale. Errors are propagated assuming independent
+meshtallies. The arrays are written to the file of the first meshtally in
+the expression. Both options can be repeated. Option --derive is not used
+with -j, --stream, --merge, --series and --watch; --scale is not used with
+--stream.
+
+Option `--stats` prints the table with wall and CPU time, peak resident
+memory during the stage and amount of data for each stage of the conversion
+(read, reshape, grid, write) of each file. Option `--stats-json F` writes
+these statistics also to the JSON file F.
+
+With `type=dgsN fmc dgs1 [...]`, activated mesh elements with zero material
+volume fraction are reported. Option `--zerovf W` writes their list: `csv`
+to the file `dgsN_zerovf.csv`, `mask` as the cell array `zero_vf` to the
+output vtr file, `csv,mask` to both.  """
 
 normalization_note = """
 Normalization constants not applied, generated vtk files contain data
@@ -29,8 +130,12 @@ for flux [1/cm2s] and heat [W/cm3]:
     Ch = {:18e}
     Cf = {:18e}
 
-To normalize tallies in Paraview, use Programmable filter. For example, to
-compute total heating from the neutron and photon components:
+To normalize tallies at conversion, use options --scale and --derive, e.g.
+
+        --scale 4=Cf --derive 'heat=(t14 + t24)*Ch'
+
+or, in Paraview, the Programmable filter. For example, to compute total
+heating from the neutron and photon components:
 
         v1 = inputs[0].CellData['val']
         v2 = inputs[1].CellData['val']
@@ -39,7 +144,56 @@ compute total heating from the neutron and photon components:
 """
 
 
-def rectangular(fname, xbounds, ybounds, zbounds, vals, errs=None, descr=[]):
+def _vtk_available():
+    """
+    Returns True if the vtk package can be imported. The import is tried only
+    once.
+    """
+    global _vtk_package
+    if _vtk_package is None:
+        try:
+            from . import vtkwriter
+            _vtk_package = True
+        except ImportError:
+            _vtk_package = False
+    return _vtk_package
+
+
+def _compression_writer(compressor, writer, numpy_only=False):
+    """
+    Returns the writer, see rectangular(), that can use `compressor`, or None
+    if the compressor cannot be used. When `numpy_only` is True, files are
+    written by tovtk.vtr regardless of `writer`. When the VTK writer does
+    not support the compressor, the numpy writer is returned if it can use
+    it. Messages are printed.
+    """
+    from .vtr import _compress_function
+    try:
+        _compress_function(compressor, None)
+        error = None
+    except ValueError as e:
+        error = e.args[0]
+    if not numpy_only and (writer == 'vtk' or
+                           (writer is None and _vtk_available())):
+        from .vtkwriter import supports, _vtkVersion
+        if supports(compressor):
+            return 'vtk'
+        if error is None:
+            print ('Compressor {} is not supported by VTK {}, files are '
+                   'written with --writer numpy').format(compressor,
+                                                         _vtkVersion)
+            return 'numpy'
+        error = 'Compressor {} is not supported by VTK {}; {}'.format(
+                compressor, _vtkVersion, error)
+    if error is not None:
+        print error
+        return None
+    return writer
+
+
+def rectangular(fname, xbounds, ybounds, zbounds, vals, errs=None, descr=[],
+                cdata=[], writer=None, pieces=None, compression=None,
+                single=False):
     """
     Write rectangular data to file `fname`.
 
@@ -47,96 +201,341 @@ def rectangular(fname, xbounds, ybounds, zbounds, vals, errs=None, descr=[]):
     is a 3-dimentional array of the shape (len(x)-1, len(y)-1, len(z)-1).
 
     Put strings from `descr` as description of the data.
+
+    Optional `cdata` is a list of (name, array) tuples for additional cell
+    data. An array of the shape (nx, ny, nz) is written as a scalar array,
+    an array of the shape (nc, nx, ny, nz) as an array with nc components.
+
+    Optional `writer` is either 'vtk' to write the file with the vtk package,
+    or 'numpy' to write it with tovtk.vtr.write_vtr(), which does not require
+    vtk. By default, 'vtk' is used when the vtk package is available.
+
+    When `pieces` is given, the grid is split into pieces written concurrently
+    to separate vtr files, and `fname` is the parallel .pvtr file referring to
+    them, see tovtk.vtr.write_pvtr(). The pieces are always written by
+    tovtk.vtr.
+
+    Optional `compression` is a dictionary with keyword arguments `encoding`,
+    `compressor`, `level` and `block_size` of the writer, see
+    tovtk.vtr.write_vtr().
+
+    When `single` is True, floating point cell data is written as float32
+    arrays. Values outside of the float32 range are reported.
     """
-    # prepare grid boundaries
-    x = vtk.vtkDoubleArray()
-    y = vtk.vtkDoubleArray()
-    z = vtk.vtkDoubleArray()
-    x.SetName('x')
-    y.SetName('y')
-    z.SetName('z')
-    for v in xbounds:
-        x.InsertNextValue(v)
-    for v in ybounds:
-        y.InsertNextValue(v)
-    for v in zbounds:
-        z.InsertNextValue(v)
-
-    # put boundaries and data into VTK rectilinear grid
-    grid = vtk.vtkRectilinearGrid()
-    grid.SetDimensions(x.GetNumberOfTuples(),
-                       y.GetNumberOfTuples(),
-                       z.GetNumberOfTuples())
-    grid.SetXCoordinates(x)
-    grid.SetYCoordinates(y)
-    grid.SetZCoordinates(z)
+    from numpy import amax, amin, asarray, ravel
+    from .stats import stage
+    if writer is None:
+        writer = 'vtk' if _vtk_available() else 'numpy'
+    compression = compression or {}
 
     # prepare array for tally values and errors
     # Value and error will be rwitten as separate scalar arrays. In this form
     # the threshold filter can be applied in paraview. This filter cannot be
     # applied to an array of vectors.
-    val = vtk.vtkDoubleArray()
 
     # Data arrays containing values and errors should heve the same name
     # for all datasets. In this case it is more simple to replace one data
     # set with another one in the paraview state. WHen datasets have
     # different names, one needs to change data arrays to be displayed
     # manually for all views.
-    val.SetName('val')
-    val.SetNumberOfComponents(1)
-    val.SetNumberOfTuples(grid.GetNumberOfCells())
-
-    if errs is not None:
-        err = vtk.vtkDoubleArray()
-        err.SetName('err')
-        err.SetNumberOfComponents(1)
-        err.SetNumberOfTuples(grid.GetNumberOfCells())
-
-    # Put tally results to values array in particular order
-    xlen = x.GetNumberOfTuples() - 1
-    ylen = y.GetNumberOfTuples() - 1
-    zlen = z.GetNumberOfTuples() - 1
-    vmax = amax(vals[vals > 0.0])
-    vmin = amin(vals[vals > 0.0])
-    for i in range(xlen):
-        for j in range(ylen):
-            for k in range(zlen):
-                idx = grid.ComputeCellId((i, j, k))
-                hn = vals[i, j, k]
-                if errs is not None:
-                    en = errs[i, j, k]
-
-                val.SetTuple(idx, (hn, ))
-                if errs is not None:
-                    err.SetTuple(idx, (en, ))
-
-    # Field data to store metadata
-    df = vtk.vtkStringArray()
-    df.SetName('Description')
-    df.SetNumberOfTuples(len(descr) + 2)
-    df.SetValue(0, 'positive min: {}'.format(vmin))
-    df.SetValue(1, 'positive max: {}'.format(vmax))
-    for i, s in enumerate(descr):
-        df.SetValue(i + 2, s)
-
-    # Attach values to the grid
-    grid.GetCellData().AddArray(val)
-    if errs is not None:
-        grid.GetCellData().AddArray(err)
-    grid.GetFieldData().AddArray(df)
-
-    # write to file:
-    writer = vtk.vtkXMLRectilinearGridWriter()
-    if _vtkVersion[0] in '68':
-        writer.SetInputData(grid)
-    else:
-        # _vtkVersion[0] == '5':
-        writer.SetInput(grid)
-    writer.SetFileName(fname)
-    ws = writer.Write()
+
+    # Cell index in VTK rectilinear grid is i + nx*(j + ny*k), i.e. x index
+    # changes fastest (see cellid.py). This is the Fortran order of the
+    # (nx, ny, nz) array.
+    with stage('reshape', fname) as st:
+        arrays = [('val', ravel(vals, order='F'))]
+        if errs is not None:
+            arrays.append(('err', ravel(errs, order='F')))
+
+        for name, a in cdata:
+            a = asarray(a)
+            if a.ndim == 4:
+                # components of a cell are adjacent in VTK array
+                a = a.transpose().reshape((-1, a.shape[0]))
+            else:
+                a = ravel(a, order='F')
+            arrays.append((name, a))
+        if single:
+            from .vtr import to_float32
+            for i, (name, a) in enumerate(arrays):
+                if a.dtype.kind != 'f':
+                    continue
+                a, n = to_float32(a)
+                arrays[i] = (name, a)
+                if n > 0:
+                    print ('Warning: {} values of {} in {} are outside of '
+                           'the float32 range'.format(n, name, fname))
+        st.nbytes = sum(a.nbytes for (name, a) in arrays)
+
+    with stage('grid', fname):
+        vmax = amax(vals[vals > 0.0])
+        vmin = amin(vals[vals > 0.0])
+
+        # Description of data is written as field data
+        descr = ['positive min: {}'.format(vmin),
+                 'positive max: {}'.format(vmax)] + list(descr)
+
+        x = asarray(xbounds, dtype=float)
+        y = asarray(ybounds, dtype=float)
+        z = asarray(zbounds, dtype=float)
+
+    with stage('write', fname) as st:
+        if pieces is not None:
+            from .vtr import write_pvtr
+            ws = write_pvtr(fname, x, y, z, arrays, descr, pieces,
+                            **compression)
+        elif writer == 'vtk':
+            from .vtkwriter import write_vtk
+            ws = write_vtk(fname, x, y, z, arrays, descr, **compression)
+        else:
+            from .vtr import write_vtr
+            ws = write_vtr(fname, x, y, z, arrays, descr, **compression)
+        if ws == 1:
+            st.nbytes = os.path.getsize(fname)
     return ws
 
 
+def energy_bins(ebins, nb):
+    """
+    Returns list of (n, m) tuples defining ranges of energy bins from strings
+    in `ebins`, see help_note. The range includes 0-based bin indices n to
+    m-1. `nb` is the number of energy bins in the meshtally.
+
+    Ranges outside of 1..nb are not included to the list, but returned as the
+    list of strings as the second element of the result tuple.
+    """
+    res = []
+    for s in ebins:
+        for e in s.split(','):
+            if e == 'all':
+                res.extend((i, i + 1) for i in range(nb))
+            elif ':' in e:
+                n, m = map(int, e.split(':'))
+                res.append((n - 1, m))
+            else:
+                n = int(e)
+                res.append((n - 1, n))
+    valid = []
+    skipped = []
+    for n, m in res:
+        if 0 <= n < m <= nb:
+            valid.append((n, m))
+        else:
+            skipped.append('{}:{}'.format(n + 1, m))
+    return valid, skipped
+
+
+def energy_data(emesh, rv, re, ebins):
+    """
+    Returns values and relative errors summed over ranges of energy bins.
+
+    `emesh` is the list of energy bin boundaries, as in MeshTally.emesh.
+    Arrays `rv` and `re` of the shape (ne, nx, ny, nz) contain values and
+    relative errors for all energy bins and, for ne > 1, the total. Ranges
+    are given by strings `ebins`, see energy_bins().
+
+    Returns arrays of values and errors of the shape (len(ranges), nx, ny, nz),
+    the list of range descriptions (label, Emin, Emax) and the list of
+    ranges not present in the meshtally.
+
+    Relative errors of sums are computed assuming that results in different
+    energy bins are independent.
+    """
+    from numpy import array, sqrt, where
+    if len(emesh) == 1:
+        # single energy bin, no total
+        eb = [0.0] + list(emesh)
+    else:
+        eb = list(emesh)
+    ranges, skipped = energy_bins(ebins, len(eb) - 1)
+    # absolute errors squared
+    ae = (rv * re)**2
+    vals = []
+    errs = []
+    labels = []
+    for n, m in ranges:
+        v = rv[n:m].sum(axis=0)
+        e = sqrt(ae[n:m].sum(axis=0))
+        vals.append(v)
+        errs.append(where(v != 0.0, e / abs(where(v != 0.0, v, 1.0)), 0.0))
+        if m - n == 1:
+            labels.append(('e{}'.format(m), eb[n], eb[m]))
+        else:
+            labels.append(('e{}-{}'.format(n + 1, m), eb[n], eb[m]))
+    return array(vals), array(errs), labels, skipped
+
+
+def write_tally(meshtal, tn, t, title, nps, ebins=None, ecomp=False,
+                writer=None, pieces=None, compression=None, single=False,
+                bounds=None, scales=None, cdata=None, extra_descr=None,
+                sources=None):
+    """
+    Write meshtally `t` with number `tn` read from file `meshtal` to a vtr file.
+
+    Optional `ebins` is a list of strings specifying energy bins to be written
+    additionally to the total, see energy_bins(). When `ecomp` is True, these
+    bins are written as multi-component arrays. `writer`, `pieces`,
+    `compression` and `single` are passed to rectangular(); with `pieces`, the
+    tally is written to the .pvtr file.
+
+    Optional `bounds` is the tuple of prepared x, y and z boundary arrays,
+    used instead of t.bounds, e.g. shared by a series of meshtallies on the
+    same mesh.
+
+    Optional `scales` is the dictionary {tally number: factor}; values of the
+    meshtally are multiplied by its factor. Optional `cdata` is a list of
+    additional (name, array) cell data tuples, see rectangular(), and
+    `extra_descr` a list of additional description strings. Optional
+    `sources` is the list of meshtal files the meshtally was obtained from,
+    e.g. merged files, written to the description instead of `meshtal`.
+
+    Returns the list of log messages and the writer status. The status is None
+    for not rectangular meshtallies that are not written.
+    """
+    log = []
+    if t.geom.lower() not in ('xyz', 'rect'):
+        return log, None
+
+    # Arrays of values and errors reshaped to account for energy bins. These
+    # are views of the MeshTally arrays, not copies.
+    sh = t.shape
+    vals = t.rvalues
+    errs = t.rerrors
+    log.append('Number of energy bins: {}'.format(sh[0]))
+    log.append('Number of x bins: {}'.format(sh[1]))
+    log.append('Number of y bins: {}'.format(sh[2]))
+    log.append('Number of z bins: {}'.format(sh[3]))
+    log.append('Number of values: {}'.format(len(t.values)))
+
+    if sh[0] > 1 and not ebins:
+        log.append('Meshtally {} contains {} energy bins.'.format(tn, sh[0]))
+        log.append('Only "total" is written to vtk file')
+
+    # Prepare array of values
+    factor = (scales or {}).get(tn)
+    rvals = vals[-1, :, :, :]
+    rerrs = errs[-1, :, :, :]
+    if factor is not None:
+        rvals = rvals * factor
+    # Additional arrays for energy bins
+    cdata = list(cdata or [])
+    edescr = []
+    if factor is not None:
+        edescr.append('Values scaled by {}'.format(factor))
+    if ebins:
+        ev, ee, labels, skipped = energy_data(t.emesh, vals, errs, ebins)
+        if factor is not None:
+            ev *= factor
+        if skipped:
+            log.append('Meshtally {} has no energy bins {}'.format(
+                       tn, ', '.join(skipped)))
+        if ecomp and labels:
+            cdata.append(('val_e', ev))
+            cdata.append(('err_e', ee))
+            for i, (l, e1, e2) in enumerate(labels):
+                edescr.append('val_e component {} ({}): {} - {} MeV'.format(
+                              i, l, e1, e2))
+        elif labels:
+            for i, (l, e1, e2) in enumerate(labels):
+                cdata.append(('val_' + l, ev[i]))
+                cdata.append(('err_' + l, ee[i]))
+                edescr.append('val_{}: {} - {} MeV'.format(l, e1, e2))
+        log.append('Energy bins written: {}'.format(
+                   ', '.join(l for (l, e1, e2) in labels)))
+    # Prepare arrays of bin boundaries
+    x, y, z = t.bounds if bounds is None else bounds
+    # Prepare description
+    descr = []
+    sources = sources or [meshtal]
+    descr.append('Meshtal file{} {}, tally {}'.format(
+                 's' if len(sources) > 1 else '', ', '.join(sources), tn))
+    descr.append(title)
+    descr.append('nps: {}'.format(nps))
+    descr.extend(edescr)
+    descr.extend(extra_descr or [])
+    fname = '{}_t{}.{}'.format(meshtal, tn,
+                               'vtr' if pieces is None else 'pvtr')
+    ws = rectangular(fname, x, y, z, rvals, errs=rerrs, descr=descr,
+                     cdata=cdata, writer=writer, pieces=pieces,
+                     compression=compression, single=single)
+
+    if ws == 1:
+        log.append('Tally {} written to {}'.format(tn, fname))
+    else:
+        log.append('Failed to write tally {} to {}'.format(tn, fname))
+    return log, ws
+
+
+def derived_arrays(name, expr, td, Ch, Cf):
+    """
+    Returns (tn, cdata, descr) for the array `name` derived by expression
+    `expr` from meshtallies in the dictionary `td`, see tovtk.derived. `tn`
+    is the number of the first meshtally in the expression, `cdata` is the
+    list with the arrays of values and relative errors and `descr` the
+    description of the array. The "total" energy bin of meshtallies is used.
+
+    ValueError is raised if the expression contains no meshtallies, if some
+    of them is not in `td`, or if their meshes differ.
+    """
+    from .derived import Quantity, evaluate, tallies
+    from .merge import same_mesh
+    tns = tallies(expr)
+    if not tns:
+        raise ValueError('No meshtallies in expression ', expr)
+    variables = {'Ch': Ch, 'Cf': Cf}
+    for tn in tns:
+        if tn not in td:
+            raise ValueError('Meshtally not found ', tn)
+        t = td[tn]
+        if t.geom.lower() not in ('xyz', 'rect'):
+            raise ValueError('Meshtally on not rectangular mesh ', tn)
+        if not same_mesh(t, td[tns[0]], energy=False):
+            raise ValueError('Meshes differ in tallies ', tns[0], ' and ', tn)
+        variables['t{}'.format(tn)] = Quantity.from_relative(
+            t.rvalues[-1], t.rerrors[-1])
+    q = evaluate(expr, variables)
+    return (tns[0], [(name, q.val), (name + '_err', q.rerr)],
+            '{}: {}'.format(name, expr))
+
+
+def _write_caches(meshtals):
+    """
+    Write missing or outdated caches of meshtal files `meshtals`. Caches are
+    written only when whole files are read; this is used before meshtallies
+    are read one by one, e.g. by worker processes, from the caches.
+    """
+    from .tallies import read_meshtal
+    from .cache import cache_stamp, load_cache
+    for meshtal in meshtals:
+        if load_cache(meshtal, cache_stamp(meshtal, 'meshtal')) is None:
+            print 'Writing cache of {} ...'.format(meshtal),
+            read_meshtal(meshtal, use_uncertainties=False, cache=True)
+            print 'complete'
+    return
+
+
+def _tally_task(args):
+    """
+    Read and write a single meshtally in a worker process.
+
+    `args` is the tuple (meshtal, tn, cache, profile, kwargs) of the meshtal
+    file name, the tally number, the cache flag, the flag to collect
+    statistics (see tovtk.stats) and keyword arguments for write_tally().
+
+    Returns log lines, the write status and the list of collected statistics.
+    """
+    from .tallies import read_meshtal
+    from . import stats
+    meshtal, tn, cache, profile, kwargs = args
+    if profile:
+        stats.enable()
+    title, nps, td = read_meshtal(meshtal, use_uncertainties=False,
+                                  tallies=[tn], cache=cache)
+    log, ws = write_tally(meshtal, tn, td[tn], title, nps, **kwargs)
+    log = ['Reading {}, tally {} ... complete'.format(meshtal, tn)] + log
+    return log, ws, stats.records()
+
+
 def main():
     # normalize to 400 W
     # c1 = 3.1567674e6 # W/MeV
@@ -147,12 +546,116 @@ def main():
 
     print normalization_note.format(c1, c2)
 
-    if len(argv) == 1:
+    from . import stats
+    from .stats import stage, count_bytes
+
+    # command line options
+    mfiles = argv[1:]
+    nproc = 1
+    ebins = []
+    ecomp = False
+    cache = False
+    writer = None
+    zerovf = []
+    stats_json = None
+    pieces = None
+    chunk = None
+    compression = {}
+    single = False
+    merge = None
+    series = None
+    interval = None
+    scales = {}
+    derived = []
+    while mfiles and mfiles[0].startswith('-'):
+        o = mfiles.pop(0)
+        try:
+            if o == '-j' and mfiles:
+                nproc = int(mfiles.pop(0))
+            elif o == '-e' and mfiles:
+                ebins.append(mfiles.pop(0))
+            elif o == '--ecomp':
+                ecomp = True
+            elif o == '--cache':
+                cache = True
+            elif o == '--writer' and mfiles and mfiles[0] in ('vtk', 'numpy'):
+                writer = mfiles.pop(0)
+            elif (o == '--zerovf' and mfiles and
+                  set(mfiles[0].split(',')) <= set(['csv', 'mask'])):
+                zerovf.extend(mfiles.pop(0).split(','))
+            elif o == '--pieces' and mfiles:
+                pieces = map(int, mfiles.pop(0).split(','))
+                if len(pieces) not in (1, 3) or min(pieces) < 1:
+                    raise ValueError('one or three numbers >= 1 expected')
+                pieces = pieces[0] if len(pieces) == 1 else tuple(pieces)
+            elif (o == '--encoding' and mfiles and
+                  mfiles[0] in ('base64', 'raw')):
+                compression['encoding'] = mfiles.pop(0)
+            elif (o == '--compressor' and mfiles and
+                  mfiles[0].split(':')[0] in ('none', 'zlib', 'lz4', 'lzma')):
+                from .vtr import LEVELS
+                c = mfiles.pop(0).split(':')
+                compression['compressor'] = c[0]
+                if len(c) > 1:
+                    level = int(c[1])
+                    if c[0] not in LEVELS:
+                        raise ValueError('no compression level for ', c[0])
+                    lmin, lmax = LEVELS[c[0]]
+                    if not lmin <= level <= lmax:
+                        raise ValueError('level of {} must be {} to {}'.format(
+                                         c[0], lmin, lmax))
+                    compression['level'] = level
+            elif o == '--block-size' and mfiles:
+                compression['block_size'] = int(mfiles.pop(0))
+                if compression['block_size'] <= 0:
+                    raise ValueError('block size must be positive')
+            elif o == '--float32':
+                single = True
+            elif o == '--stream' and mfiles:
+                chunk = int(float(mfiles.pop(0)) * 2**20)
+                if chunk <= 0:
+                    raise ValueError('chunk size must be positive')
+            elif o == '--merge' and mfiles:
+                merge = mfiles.pop(0)
+            elif (o == '--series' and mfiles and
+                  mfiles[0].split(':')[1:] in ([], ['nps'], ['index'])):
+                series = (mfiles.pop(0) + ':nps').split(':')[:2]
+            elif o == '--watch' and mfiles:
+                interval = float(mfiles.pop(0))
+            elif o == '--scale' and mfiles and '=' in mfiles[0]:
+                from .derived import evaluate
+                n, c = mfiles.pop(0).split('=', 1)
+                scales[int(n)] = evaluate(c, {'Ch': c1, 'Cf': c2})
+            elif o == '--derive' and mfiles:
+                from .derived import definition
+                derived.append(definition(mfiles.pop(0)))
+            elif o == '--stats':
+                stats.enable()
+            elif o == '--stats-json' and mfiles:
+                stats_json = mfiles.pop(0)
+                stats.enable()
+            else:
+                print 'Unknown option', o
+                print help_note
+                return 2
+        except (ValueError, SyntaxError) as e:
+            print 'Wrong value of option {}: {}'.format(
+                o, ''.join(map(str, e.args)))
+            print help_note
+            return 2
+
+    if compression.get('compressor') in ('lz4', 'lzma'):
+        # check the compressor before any file is read. Pieces and
+        # streaming use only tovtk.vtr.
+        writer = _compression_writer(compression['compressor'], writer,
+                                     pieces is not None or chunk is not None)
+        if writer is None:
+            return 2
+
+    if not mfiles:
         print help_note
         return
     else:
-        mfiles = argv[1:]
-
         # meshtal or dgs?
         if mfiles[0] == 'type=dgs':
             dtype = 'dgs'
@@ -167,93 +670,239 @@ def main():
         else:
             dtype = 'meshtal'
 
-    if dtype == 'meshtal':
+    # number of files that could not be written
+    nfail = 0
+    # number of arrays that could not be derived
+    nderive = 0
+    if derived and (dtype != 'meshtal' or nproc > 1 or chunk is not None or
+                    merge is not None or series is not None or
+                    interval is not None):
+        print ('Option --derive is only used for meshtal files without -j, '
+               '--stream, --merge, --series and --watch')
+    # options for writing meshtallies
+    wopts = {'ebins': ebins, 'ecomp': ecomp, 'writer': writer,
+             'pieces': pieces, 'compression': compression,
+             'single': single, 'scales': scales}
+    # extension of output files
+    ext = 'vtr' if pieces is None else 'pvtr'
+    if dtype == 'meshtal' and merge is not None:
+        from .merge import common_tallies, merge_tally
+        if chunk is not None or nproc > 1:
+            print 'Options -j and --stream are not used with --merge'
+        if cache:
+            # meshtallies are merged one by one
+            _write_caches(mfiles)
+        print 'Merging {} files to {}'.format(len(mfiles), merge)
+        tallies, missing = common_tallies(mfiles)
+        for tn in sorted(missing):
+            print 'Meshtally {} not merged, missing in {}'.format(
+                tn, ', '.join(missing[tn]))
+        for tn in tallies:
+            try:
+                title, nps, t = merge_tally(mfiles, tn, cache=cache)
+            except ValueError as e:
+                print 'Meshtally {} not merged: {}'.format(tn, e)
+                nfail += 1
+                continue
+            log, ws = write_tally(merge, tn, t, title, nps, sources=mfiles,
+                                  **wopts)
+            for l in log:
+                print l
+            if ws is not None and ws != 1:
+                nfail += 1
+    elif dtype == 'meshtal' and interval is not None:
+        from .watch import watch
+        if chunk is not None or nproc > 1:
+            print 'Options -j and --stream are not used with --watch'
+        print 'Watching {} every {} s, stop with Ctrl-C'.format(
+            ', '.join(mfiles), interval)
+        try:
+            for log, ws in watch(mfiles, interval, **wopts):
+                for l in log:
+                    print l
+                if ws is not None and ws != 1:
+                    nfail += 1
+        except KeyboardInterrupt:
+            print 'Watching stopped'
+    elif dtype == 'meshtal' and series is not None:
+        from .series import convert_series
+        if chunk is not None or nproc > 1:
+            print 'Options -j and --stream are not used with --series'
+        for log, ws in convert_series(mfiles, series[0], series[1], cache,
+                                      **wopts):
+            for l in log:
+                print l
+            if ws is not None and ws != 1:
+                nfail += 1
+    elif dtype == 'meshtal' and chunk is not None:
+        if scales:
+            print 'Option --scale is not used with --stream'
+        from .stream import stream_meshtal
+        if ebins or pieces is not None or nproc > 1:
+            print 'Options -e, -j and --pieces are not used with --stream'
+        for meshtal in mfiles:
+            print 'Reading {} in chunks of {} bytes'.format(meshtal, chunk)
+            for log, ws in stream_meshtal(meshtal, chunk, compression,
+                                          single):
+                for l in log:
+                    print l
+                if ws is not None and ws != 1:
+                    nfail += 1
+    elif dtype == 'meshtal' and nproc > 1:
+        from multiprocessing import Pool
+        from .tallies import meshtal_index
+        # Each worker reads a single tally, using the index of the meshtal
+        # file, and writes it. Log messages are printed in the order of tasks.
+        if cache:
+            _write_caches(mfiles)
+        tasks = []
+        for meshtal in mfiles:
+            for tn in sorted(meshtal_index(meshtal).keys()):
+                tasks.append((meshtal, tn, cache, stats.enabled(), wopts))
+        pool = Pool(nproc)
+        for log, ws, recs in pool.imap(_tally_task, tasks):
+            stats.add(recs)
+            for l in log:
+                print l
+            if ws is not None and ws != 1:
+                nfail += 1
+        pool.close()
+        pool.join()
+    elif dtype == 'meshtal':
+        from .tallies import read_meshtal
         for meshtal in mfiles:
             print 'Reading {} ...'.format(meshtal),
 
-            title, nps, td = read_meshtal(meshtal, use_uncertainties=False)
+            title, nps, td = read_meshtal(meshtal, use_uncertainties=False,
+                                          cache=cache)
             print 'complete'
 
-            for tn, t in td.items():
-                if t.geom.lower() not in ('xyz', 'rect'):
+            # arrays derived from several meshtallies, by the first one
+            extra = {}
+            for name, expr in derived:
+                try:
+                    tn, cd, d = derived_arrays(name, expr, td, c1, c2)
+                except ValueError as e:
+                    print 'Array {} not derived: {}'.format(
+                        name, ''.join(map(str, e.args)))
+                    nderive += 1
                     continue
-
-                vals = array(t.values)
-                errs = array(t.errors)
-
-                # reshape arrays, to account for energy bins:
-                sh = (len(t.emesh), len(t.imesh), len(t.jmesh), len(t.kmesh))
-                print 'Number of energy bins:', sh[0]
-                print 'Number of x bins:', sh[1]
-                print 'Number of y bins:', sh[2]
-                print 'Number of z bins:', sh[3]
-                print 'Number of values:', len(t.values)
-
-                if sh[0] > 1:
-                    print 'Meshtally {} contains {} energy bins.'.format(tn, sh[0])
-                    print 'Only "total" is written to vtk file'
-
-                # Prepare array of values
-                rvals = reshape(vals, sh)[-1, :, :, :]
-                rerrs = reshape(errs, sh)[-1, :, :, :]
-                # Prepare arrays of bin boundaries
-                x = [t.origin.x] + t.imesh
-                y = [t.origin.y] + t.jmesh
-                z = [t.origin.z] + t.kmesh
-                # Prepare description
-                descr = []
-                descr.append('Meshtal file {}, tally {}'.format(meshtal, tn))
-                descr.append(title)
-                descr.append('nps: {}'.format(nps))
-                fname = '{}_t{}.vtr'.format(meshtal, tn)
-                ws = rectangular(fname, x, y, z, rvals, errs=rerrs, descr=descr)
-
-                if ws == 1:
-                    print 'Tally {} written to {}'.format(tn, fname)
-                else:
-                    print 'Failed to write tally {} to {}'.format(tn, fname)
+                extra.setdefault(tn, ([], []))
+                extra[tn][0].extend(cd)
+                extra[tn][1].append(d)
+            for tn, t in td.items():
+                cd, d = extra.get(tn, (None, None))
+                log, ws = write_tally(meshtal, tn, t, title, nps, cdata=cd,
+                                      extra_descr=d, **wopts)
+                for l in log:
+                    print l
+                if ws is not None and ws != 1:
+                    nfail += 1
     elif dtype == 'dgs':
+        from .dgs import readdgs
         for dgs in mfiles:
             print 'Reading ', dgs
-            x, y, z, a = readdgs(dgs)
-            fname = '{}.vtr'.format(dgs)
-            ws = rectangular(fname, x, y, z, a, errs=None)
+            with stage('read', dgs):
+                x, y, z, a = readdgs(dgs, cache=cache)
+                count_bytes(os.path.getsize(dgs))
+            fname = '{}.{}'.format(dgs, ext)
+            ws = rectangular(fname, x, y, z, a, errs=None, writer=writer,
+                             pieces=pieces, compression=compression,
+                             single=single)
+            if ws != 1:
+                nfail += 1
     elif dtype == 'dgsN':
+        from numpy import (array_equal, argwhere, count_nonzero, errstate,
+                           savetxt, column_stack, uint8)
+        from .dgs import readdgs
+        from .fmc import read_vol_frac
         print 'Reading vol.fractions from ', fmc
-        x0, y0, z0, vf = read_vol_frac(fmc)
-        fname = '{}_vf.vtr'.format(fmc)
-        ws = rectangular(fname, x0, y0, z0, vf, errs=None)
+        with stage('read', fmc):
+            x0, y0, z0, vf = read_vol_frac(fmc, cache=cache)
+            count_bytes(os.path.getsize(fmc))
+        fname = '{}_vf.{}'.format(fmc, ext)
+        ws = rectangular(fname, x0, y0, z0, vf, errs=None, writer=writer,
+                         pieces=pieces, compression=compression,
+                         single=single)
         if ws == 1:
             print 'Vol. fractions written to', fname
         else:
             print'Failed to write vol. fractions to', fname
+            nfail += 1
         for dgs in mfiles:
             print 'Reading ', dgs
-            x, y, z, a = readdgs(dgs)
-            assert x == x0 and y == y0 and z == z0
-            assert a.shape == vf.shape
+            with stage('read', dgs):
+                x, y, z, a = readdgs(dgs, cache=cache)
+                count_bytes(os.path.getsize(dgs))
+            if not (array_equal(x, x0) and array_equal(y, y0) and
+                    array_equal(z, z0)):
+                print 'Mesh in {} differs from that in {}'.format(dgs, fmc)
+                nfail += 1
+                continue
             # Normalize gamma intensity in mesh element to gamma intencity in
             # material volume
             mask = a > 0.0
-            if not all(vf[mask] > 0):
-                print 'There are zero material vol. fracs in activated elements'
-                # print indices of mesh elements, where a > 0 and vf is zero:
-                for i in range(a.shape[0]):
-                    for j in range(a.shape[1]):
-                        for k in range(a.shape[2]):
-                            if a[i, j, k] > 0 and vf[i, j, k] == 0:
-                                print i+1, j+1, k+1, a[i, j, k], vf[i, j, k]
-            a[mask] = a[mask] / vf[mask]
-
-            fname = '{}N.vtr'.format(dgs)
-            ws = rectangular(fname, x, y, z, a, errs=None)
+            zero = mask & (vf == 0.0)
+            nz = count_nonzero(zero)
+            # 1-based indices of mesh elements, where a > 0 and vf is zero
+            ijk = argwhere(zero) + 1
+            if nz > 0:
+                print ('There are zero material vol. fracs in {} activated '
+                       'elements'.format(nz))
+                for (i, j, k), v in zip(ijk[:10], a[zero][:10]):
+                    print i, j, k, v
+                if nz > 10:
+                    print '...'
+            if 'csv' in zerovf:
+                cname = '{}N_zerovf.csv'.format(dgs)
+                savetxt(cname, column_stack((ijk, a[zero])), delimiter=',',
+                        fmt=['%d', '%d', '%d', '%.6e'], header='i,j,k,a',
+                        comments='')
+                print 'Elements with zero vol. fractions written to', cname
+            cdata = []
+            if 'mask' in zerovf:
+                cdata.append(('zero_vf', zero.astype(uint8)))
+            with errstate(divide='ignore'):
+                a[mask] = a[mask] / vf[mask]
+
+            fname = '{}N.{}'.format(dgs, ext)
+            ws = rectangular(fname, x, y, z, a, errs=None, cdata=cdata,
+                             writer=writer, pieces=pieces,
+                             compression=compression, single=single)
+            if ws != 1:
+                nfail += 1
     elif dtype == 'dgs.old':
+        from .dgs import readdgs_old
         for dgs in mfiles:
             print 'Reading ', dgs
-            x, y, z, a = readdgs_old(dgs)
-            fname = '{}.vtr'.format(dgs)
-            ws = rectangular(fname, x, y, z, a, errs=None)
+            with stage('read', dgs):
+                x, y, z, a = readdgs_old(dgs, cache=cache)
+                count_bytes(os.path.getsize(dgs))
+            fname = '{}.{}'.format(dgs, ext)
+            ws = rectangular(fname, x, y, z, a, errs=None, writer=writer,
+                             pieces=pieces, compression=compression,
+                             single=single)
+            if ws != 1:
+                nfail += 1
+
+    if stats.enabled():
+        recs = stats.records()
+        print
+        for l in stats.summary(recs):
+            print l
+        if stats_json is not None:
+            import json
+            with open(stats_json, 'w') as f:
+                json.dump(recs, f, indent=1)
+
+    if nderive > 0:
+        print 'Failed to derive {} array(s)'.format(nderive)
+    if nfail > 0:
+        print 'Failed to write {} file(s)'.format(nfail)
+    if nfail > 0 or nderive > 0:
+        return 1
+    return 0
 
 
 if __name__ == '__main__':
-    main()
+    exit(main())
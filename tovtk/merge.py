@@ -0,0 +1,93 @@
+# Statistical merging of meshtal files from independent runs
+"""
+Meshtallies from independent runs of the same problem (e.g. with different
+random number seeds) are combined tally by tally. For a mesh element with
+the value x_i and the relative error r_i in run i with n_i histories, the
+merged value and relative error are
+
+    x = sum(n_i * x_i) / N,  N = sum(n_i)
+    r = sqrt(sum((n_i * r_i * x_i)**2)) / sum(n_i * x_i)
+
+i.e. the mean of the runs weighted by their number of histories, and the
+error of this mean for independent estimates x_i.
+
+The files are read one at a time, only sums over the runs are kept, so the
+required memory does not depend on the number of files.
+"""
+from numpy import array_equal, sqrt, where
+from .tallies import read_meshtal, meshtal_index
+
+
+def same_mesh(t1, t2, energy=True):
+    """
+    Returns True if meshtallies `t1` and `t2` have the same geometry, spatial
+    and, if `energy` is True, energy bins.
+    """
+    b1, b2 = t1.bounds, t2.bounds
+    if energy:
+        b1, b2 = b1 + (t1.ebounds, ), b2 + (t2.ebounds, )
+    if t1.geom != t2.geom or map(len, b1) != map(len, b2):
+        return False
+    return all(array_equal(a1, a2) for (a1, a2) in zip(b1, b2))
+
+
+def common_tallies(meshtals):
+    """
+    Returns the sorted list of numbers of meshtallies written in the 'col'
+    format to all files `meshtals`, and the dictionary {n: [files]} of other
+    meshtallies with the files missing them.
+    """
+    index = [meshtal_index(m) for m in meshtals]
+    tallies = set()
+    for d in index:
+        tallies.update(n for (n, (h, t)) in d.items() if t >= 0)
+    common = []
+    missing = {}
+    for n in sorted(tallies):
+        m = [f for (f, d) in zip(meshtals, index) if d.get(n, (0, -1))[1] < 0]
+        if m:
+            missing[n] = m
+        else:
+            common.append(n)
+    return common, missing
+
+
+def merge_tally(meshtals, tn, cache=False):
+    """
+    Returns (title, nps, t) with the title of the first file, the total
+    number of histories and meshtally `tn` merged from files `meshtals`.
+
+    The meshtally object is the one read from the first file, with values
+    and relative errors replaced by the merged ones. ValueError is raised if
+    the meshtally is not found in some file, if its mesh differs from that
+    in the first file, or if some file gives no number of histories.
+    """
+    nps = 0
+    for meshtal in meshtals:
+        title, n, td = read_meshtal(meshtal, use_uncertainties=False,
+                                    tallies=[tn], cache=cache)
+        t = td[tn]
+        if n <= 0:
+            raise ValueError('number of histories not found in {}'.format(
+                             meshtal))
+        if nps == 0:
+            t0, title0 = t, title
+            # sums of n*x and (n*r*x)**2 over the runs
+            s = t.values * n
+            v = (s * t.errors)**2
+            # results are kept only in the sums
+            t.values = t.errors = []
+        elif not same_mesh(t0, t):
+            raise ValueError('mesh in {} differs from that in {}'.format(
+                             meshtal, meshtals[0]))
+        else:
+            a = t.values * n
+            s += a
+            a *= t.errors
+            a **= 2
+            v += a
+        nps += n
+        del td, t
+    t0.values = s / nps
+    t0.errors = where(s != 0.0, sqrt(v) / abs(where(s != 0.0, s, 1.0)), 0.0)
+    return title0, nps, t0
@@ -0,0 +1,113 @@
+# Time series of meshtal files
+"""
+A sequence of meshtal files, e.g. snapshots from successive restart runs, is
+converted to the usual vtr files of each meshtally and to the collection
+files NAME_tN.pvd, which Paraview opens as a single time-dependent dataset.
+The number of histories (or the index of the file in the sequence) is the
+timestep value.
+
+The mesh of each meshtally is checked once, against the first converted
+step; coordinate arrays prepared for this step are reused for the following
+ones. Outputs not older than their meshtal file are considered current and
+are not written again; meshtal files with all outputs current are not read.
+"""
+import os
+from .tallies import _read_blocks, meshtal_index, read_meshtal
+from .merge import same_mesh
+from .vtr import write_pvd
+
+# Kinds of timestep values
+TIMESTEPS = ('nps', 'index')
+
+
+def _nps(meshtal):
+    """
+    Returns the number of histories from the header of file `meshtal`.
+    """
+    with open(meshtal, 'r') as f:
+        f.readline()
+        f.readline()
+        nps, lcount = _read_blocks(f, {}, False, lcount=2, ntal=0)
+    return nps
+
+
+def _rectangular(meshtal, index, n):
+    """
+    Returns True if meshtally `n` in file `meshtal` with `index` (see
+    tovtk.tallies.index_meshtal()) has rectangular mesh. Only the header of
+    the meshtally is read.
+    """
+    res = {}
+    with open(meshtal, 'r') as f:
+        f.seek(index[n][0])
+        _read_blocks(f, res, False, ntal=1, tables={})
+    return res[n].geom.lower() in ('xyz', 'rect')
+
+
+def current(fname, source):
+    """
+    Returns True if file `fname` exists and is not older than file `source`.
+    """
+    return (os.path.exists(fname) and
+            os.path.getmtime(fname) >= os.path.getmtime(source))
+
+
+def convert_series(meshtals, name, timestep='nps', cache=False, **kwargs):
+    """
+    Generator of (log, ws) tuples, as tovtk.main.write_tally(), for the steps
+    of meshtallies in files `meshtals` and for the collection files
+    `name`_tN.pvd. Keyword arguments `kwargs` are passed to write_tally().
+
+    Meshtallies are read from each file only if their outputs are not
+    current; meshtallies on not rectangular meshes are not written.
+    Meshtallies whose mesh differs from that in the first step are not
+    written; the write status for them is 0.
+    """
+    from .main import write_tally
+    ext = 'vtr' if kwargs.get('pieces') is None else 'pvtr'
+    # first step of each meshtally, its bounds and the list of steps
+    first = {}
+    bounds = {}
+    steps = {}
+    for i, meshtal in enumerate(meshtals):
+        index = meshtal_index(meshtal)
+        tallies = sorted(n for (n, (h, t)) in index.items() if t >= 0)
+        outputs = dict((n, '{}_t{}.{}'.format(meshtal, n, ext))
+                       for n in tallies)
+        stale = [n for n in tallies if not current(outputs[n], meshtal) and
+                 _rectangular(meshtal, index, n)]
+        if stale:
+            title, nps, td = read_meshtal(
+                meshtal, use_uncertainties=False, cache=cache,
+                tallies=None if len(stale) == len(tallies) else stale)
+        else:
+            nps, td = _nps(meshtal), {}
+            yield ['Outputs of {} are current'.format(meshtal)], None
+        for n in stale:
+            t = td.pop(n)
+            if n not in first:
+                first[n] = t
+                bounds[n] = t.bounds
+            elif not same_mesh(first[n], t):
+                yield ['Mesh of tally {} in {} differs from that in the '
+                       'first step'.format(n, meshtal)], 0
+                continue
+            log, ws = write_tally(meshtal, n, t, title, nps,
+                                  bounds=bounds[n], **kwargs)
+            # only the mesh of the first step is kept
+            t.values = t.errors = []
+            yield log, ws
+        for n in tallies:
+            if os.path.exists(outputs[n]):
+                steps.setdefault(n, []).append(
+                    (nps if timestep == 'nps' else i, outputs[n]))
+    for n in sorted(steps):
+        fname = '{}_t{}.pvd'.format(name, n)
+        ws = write_pvd(fname, steps[n])
+        if ws == 1:
+            log = ['Series of tally {} ({} steps) written to {}'.format(
+                   n, len(steps[n]), fname)]
+        else:
+            log = ['Failed to write series of tally {} to {}'.format(
+                   n, fname)]
+        yield log, ws
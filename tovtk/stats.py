@@ -0,0 +1,220 @@
+# Per-stage timing statistics
+"""
+Collects wall time, CPU time, peak resident memory during the stage and the
+number of processed bytes for stages of the conversion (read, reshape, grid,
+write).
+
+Collection is off by default; while it is off, stage() returns an object
+doing nothing. Use:
+
+    enable()
+    with stage('read', fname) as s:
+        ...
+        s.nbytes += n        # or count_bytes(n) from nested code
+
+    print summary()
+"""
+import os
+import time
+
+# Collected records, None while collection is disabled
+_records = None
+
+# Stack of currently running stages
+_running = []
+
+
+def enable():
+    """
+    Start collection of statistics.
+    """
+    global _records
+    if _records is None:
+        _records = []
+    return
+
+
+def enabled():
+    return _records is not None
+
+
+def _hwm():
+    """
+    Returns the high-water mark of the resident set size of the process in
+    MB, or None if it cannot be determined.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for l in f:
+                if l.startswith('VmHWM:'):
+                    # in kB
+                    return int(l.split()[1]) / 1024.0
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+def _reset_hwm():
+    """
+    Resets the high-water mark of the resident set size to the current
+    resident set size. Returns False if this is not possible, e.g. on systems
+    other than Linux.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except IOError:
+        return False
+    return _hwm() is not None
+
+
+def _max_rss():
+    """
+    Returns the lifetime peak resident set size of the process in MB, or None
+    if it cannot be determined.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class _Stage(object):
+    """
+    Context manager measuring one stage.
+
+    The peak resident set size of the stage is measured by resetting the
+    high-water mark of the process at the start of the stage (on Linux). The
+    peak of an enclosing stage includes the peaks of its nested stages.
+    Without the reset, the lifetime peak of the process is the peak of the
+    stage only if it increased during the stage, otherwise the peak is
+    unknown (None).
+    """
+    def __init__(self, name, fname, tally):
+        self.name = name
+        self.fname = fname
+        self.tally = tally
+        self.nbytes = 0
+        self.peak = None
+
+    def __enter__(self):
+        # the peak so far belongs to the enclosing stages
+        h = _hwm()
+        for s in _running:
+            s._update(h)
+        _running.append(self)
+        self.__reset = _reset_hwm()
+        self.__max = _max_rss()
+        self.__t = time.time()
+        self.__c = sum(os.times()[:2])
+        return self
+
+    def _update(self, peak):
+        if peak is not None and (self.peak is None or peak > self.peak):
+            self.peak = peak
+        return
+
+    def __exit__(self, *exc):
+        wall = time.time() - self.__t
+        cpu = sum(os.times()[:2]) - self.__c
+        _running.remove(self)
+        if self.__reset:
+            self._update(_hwm())
+        else:
+            m = _max_rss()
+            if m is not None and self.__max is not None and m > self.__max:
+                self._update(m)
+        for s in _running:
+            s._update(self.peak)
+        _records.append({'stage': self.name,
+                         'file': self.fname,
+                         'tally': self.tally,
+                         'wall': wall,
+                         'cpu': cpu,
+                         'peak_rss_mb': self.peak,
+                         'bytes': self.nbytes})
+        return False
+
+
+class _NoStage(object):
+    """
+    Replacement of _Stage when collection is disabled.
+    """
+    nbytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def stage(name, fname, tally=None):
+    """
+    Returns context manager measuring stage `name` for file `fname` and
+    tally number `tally`.
+    """
+    if _records is None:
+        return _NoStage()
+    return _Stage(name, fname, tally)
+
+
+def count_bytes(n):
+    """
+    Add `n` bytes to the innermost running stage.
+    """
+    if _running:
+        _running[-1].nbytes += n
+    return
+
+
+def records():
+    """
+    Returns list of collected records and clears it.
+    """
+    global _records
+    res = _records or []
+    if _records is not None:
+        _records = []
+    return res
+
+
+def add(recs):
+    """
+    Add records collected elsewhere, e.g. in a worker process.
+    """
+    if _records is not None:
+        _records.extend(recs)
+    return
+
+
+def summary(recs):
+    """
+    Returns list of lines with the table of records `recs` and totals of
+    each stage.
+    """
+    fmt = '{:8s} {:>30s} {:>6s} {:>9s} {:>9s} {:>14s} {:>10s}'
+    res = [fmt.format('stage', 'file', 'tally', 'wall, s', 'cpu, s',
+                      'stage peak, MB', 'data, MB')]
+    fmt = '{:8s} {:>30s} {:>6s} {:9.3f} {:9.3f} {:>14s} {:10.2f}'
+    totals = {}
+    order = []
+    for r in recs:
+        peak = '' if r['peak_rss_mb'] is None else '{:.1f}'.format(
+            r['peak_rss_mb'])
+        tally = '' if r['tally'] is None else str(r['tally'])
+        res.append(fmt.format(r['stage'], r['file'][-30:], tally, r['wall'],
+                              r['cpu'], peak, r['bytes'] / 2.0**20))
+        if r['stage'] not in totals:
+            order.append(r['stage'])
+            totals[r['stage']] = [0.0, 0.0, 0]
+        t = totals[r['stage']]
+        t[0] += r['wall']
+        t[1] += r['cpu']
+        t[2] += r['bytes']
+    for s in order:
+        w, c, b = totals[s]
+        res.append(fmt.format(s, 'total', '', w, c, '', b / 2.0**20))
+    return res
@@ -0,0 +1,162 @@
+# Streaming conversion of meshtal files larger than the available memory
+"""
+Meshtallies are converted one by one. The table with results is read in
+chunks of lines; values and errors of the "total" energy bin are put directly
+to their positions in VTK cell order in temporary memory-mapped files, which
+are then compressed block by block to the vtr file, see tovtk.vtr.
+
+Memory used for parsing is limited by the chunk size. The temporary files are
+created next to the output files; the memory occupied by their pages can be
+reclaimed by the operating system.
+"""
+import os
+from tempfile import TemporaryFile
+from numpy import memmap, arange
+from .tallies import _read_blocks, _parse_rows
+from .vtr import write_vtr, to_float32
+from .stats import stage, count_bytes
+
+# Default chunk size in bytes
+CHUNK_SIZE = 2**26
+
+
+def _lines(f, n, chunk):
+    """
+    Generator of lists of lines, with about `chunk` bytes each, from the next
+    `n` lines of file `f`. At the end, `f` is positioned after these lines.
+    """
+    i = 0
+    while i < n:
+        lines = f.readlines(chunk)
+        if not lines:
+            raise ValueError('Unexpected end of file ', f.name, n, i)
+        if len(lines) > n - i:
+            # return lines after the n-th back to the file
+            f.seek(-len(''.join(lines[n - i:])), 1)
+            lines = lines[:n - i]
+        i += len(lines)
+        yield lines
+
+
+def _stream_tally(f, meshtal, title, nps, chunk, compression=None,
+                  single=False, lcount=0):
+    """
+    Read meshtally, whose header starts at the current position in file `f`,
+    and write the "total" energy bin to the vtr file. The table with results
+    is read in chunks of `chunk` bytes. At the end, `f` is positioned after
+    the table. Optional `compression` is a dictionary with keyword arguments
+    of tovtk.vtr.write_vtr(). When `single` is True, values and errors are
+    stored and written as float32, see tovtk.main.rectangular(). `lcount`
+    is the number of lines preceeding the current position in `f`, used for
+    error messages.
+
+    Returns the list of log messages, the writer status, as
+    tovtk.main.write_tally(), and the number of lines preceeding the final
+    position in `f`, or None, if there are no more tallies in `f`.
+    """
+    log = []
+    res = {}
+    tables = {}
+    offset = f.tell()
+    lcount = _read_blocks(f, res, False, lcount=lcount, ntal=1,
+                          tables=tables)[1]
+    if not res:
+        return None
+    tn, t = res.items()[0]
+    if tn not in tables:
+        # no table in the column format, f is positioned before the next
+        # tally header
+        return log, None, lcount
+    ncol, iv, ir = tables[tn]
+    ne, ni, nj, nk = t.shape
+    n = ni * nj * nk
+    if t.geom.lower() not in ('xyz', 'rect'):
+        for lines in _lines(f, ne * n, chunk):
+            pass
+        return log, None, lcount + ne * n
+    log.append('Number of energy bins: {}'.format(ne))
+    log.append('Number of x bins: {}'.format(ni))
+    log.append('Number of y bins: {}'.format(nj))
+    log.append('Number of z bins: {}'.format(nk))
+    log.append('Number of values: {}'.format(ne * n))
+    if ne > 1:
+        log.append('Meshtally {} contains {} energy bins.'.format(tn, ne))
+        log.append('Only "total" is written to vtk file')
+
+    fname = '{}_t{}.vtr'.format(meshtal, tn)
+    tdir = os.path.dirname(os.path.abspath(fname))
+    dtype = 'float32' if single else float
+    vals = memmap(TemporaryFile(dir=tdir), dtype=dtype, mode='w+',
+                  shape=(n, ))
+    errs = memmap(TemporaryFile(dir=tdir), dtype=dtype, mode='w+',
+                  shape=(n, ))
+    # number of values and errors outside of the float32 range
+    nout = [0, 0]
+    with stage('read', meshtal, tn):
+        # The "total" bin is the last block of the table
+        for lines in _lines(f, (ne - 1) * n, chunk):
+            pass
+        lcount += (ne - 1) * n
+        vmin = vmax = None
+        i = 0
+        for lines in _lines(f, n, chunk):
+            a = _parse_rows(lines, ncol, lcount)
+            # Rows are in the order of the (ni, nj, nk) array, cells in VTK
+            # follow in the Fortran order of this array.
+            c = arange(i, i + len(a))
+            v = c // (nj*nk) + ni * (c // nk % nj + nj * (c % nk))
+            if single:
+                for j, (col, out) in enumerate(((iv, vals), (ir, errs))):
+                    out[v], m = to_float32(a[:, col])
+                    nout[j] += m
+            else:
+                vals[v] = a[:, iv]
+                errs[v] = a[:, ir]
+            p = a[:, iv][a[:, iv] > 0.0]
+            if p.size > 0:
+                vmin = p.min() if vmin is None else min(vmin, p.min())
+                vmax = p.max() if vmax is None else max(vmax, p.max())
+            i += len(a)
+            lcount += len(a)
+        count_bytes(f.tell() - offset)
+    for name, m in zip(('val', 'err'), nout):
+        if m > 0:
+            log.append('Warning: {} values of {} in {} are outside of the '
+                       'float32 range'.format(m, name, fname))
+
+    descr = ['positive min: {}'.format(vmin),
+             'positive max: {}'.format(vmax),
+             'Meshtal file {}, tally {}'.format(meshtal, tn),
+             title,
+             'nps: {}'.format(nps)]
+    with stage('write', fname) as st:
+        x, y, z = t.bounds
+        ws = write_vtr(fname, x, y, z, [('val', vals), ('err', errs)], descr,
+                       **(compression or {}))
+        if ws == 1:
+            st.nbytes = os.path.getsize(fname)
+    del vals, errs
+
+    if ws == 1:
+        log.append('Tally {} written to {}'.format(tn, fname))
+    else:
+        log.append('Failed to write tally {} to {}'.format(tn, fname))
+    return log, ws, lcount
+
+
+def stream_meshtal(meshtal, chunk=CHUNK_SIZE, compression=None, single=False):
+    """
+    Generator of (log, ws) tuples, see _stream_tally(), for meshtallies in
+    file `meshtal`. The file is read sequentially, each meshtally is written
+    before the next one is read.
+    """
+    with open(meshtal, 'r') as f:
+        tit = [f.readline(), f.readline()]
+        nps, lcount = _read_blocks(f, {}, False, lcount=2, ntal=0)
+        while True:
+            r = _stream_tally(f, meshtal, tit[-1], nps, chunk, compression,
+                              single, lcount)
+            if r is None:
+                break
+            log, ws, lcount = r
+            yield log, ws
@@ -4,25 +4,63 @@
 # Developed at INR, Karlsruhe Institute of Technology
 #at
 
-try:
-    from uncertainties import Variable
-    _uncertainties_package = True
-except ImportError:
-    _uncertainties_package = False
+import os
+import mmap
+from numpy import (empty, fromstring, concatenate, asarray, array, reshape,
+                   searchsorted, broadcast_arrays, where, full, isnan, nan,
+                   arange, unravel_index, append)
+from .cache import cache_stamp, load_cache, save_cache
+from .stats import stage, count_bytes
+
+
+def _uncertainties_package():
+    """
+    Returns True if the uncertainties package is available. It is imported
+    only when needed, i.e. when read_meshtal() is called with
+    use_uncertainties=True.
+    """
+    try:
+        from uncertainties import Variable
+    except ImportError:
+        return False
+    return True
+
 
 class Vector3(object):
     """
     Replacement of the pirs.Vector3.
     """
+    __slots__ = ('x', 'y', 'z')
+
     def __init__(self, xyz):
         self.x = xyz[0]
         self.y = xyz[1]
         self.z = xyz[2]
 
+    # Classes with __slots__ are pickled with protocols 0 and 1 only if they
+    # define __getstate__.
+    def __getstate__(self):
+        return (self.x, self.y, self.z)
+
+    def __setstate__(self, state):
+        self.x, self.y, self.z = state
+
 
 # from .mctal import str2float
 str2float = float
 
+
+def _bin_index(b, p):
+    """
+    Returns array of indices of bins with boundaries `b` that contain values
+    `p`. Bin i contains values b[i] < p <= b[i+1], the first bin contains
+    also b[0]. For values outside of the bins, the index is -1.
+    """
+    i = searchsorted(b, p, side='left') - 1
+    i = where(p == b[0], 0, i)
+    return where((i < 0) | (i >= len(b) - 1) | isnan(p), -1, i)
+
+
 class MeshTally(object):
     """Representation of mesh tally.
 
@@ -53,6 +91,12 @@ class MeshTally(object):
     """
     PRECISION = 9
 
+    # Names are mangled as the attributes in __init__.
+    __slots__ = ('__geo', '__ori', '__axs', '__vec', '__ime', '__iin',
+                 '__jme', '__jin', '__kme', '__kin', '__eme', '__ein', '__fac',
+                 '__out', '__tr', '__cmt', '__par', '__typ', '__fmt', '__val',
+                 '__err')
+
     def __init__(self):
         self.__geo = 'xyz'
         self.__ori = Vector3((0,0,0))
@@ -77,6 +121,17 @@ class MeshTally(object):
         self.__err = []   # place for result rel.errors
         return
 
+    def __getstate__(self):
+        """
+        Returns the tuple of slot values, for pickle.
+        """
+        return tuple(getattr(self, '_MeshTally' + s) for s in self.__slots__)
+
+    def __setstate__(self, state):
+        for s, v in zip(self.__slots__, state):
+            setattr(self, '_MeshTally' + s, v)
+        return
+
     @property
     def geom(self):
         """
@@ -290,28 +345,144 @@ class MeshTally(object):
             self.__fmt = 'fm{0:<} -1 0 -6 -8' # Sf * Qfiss
         return
 
+    @property
+    def bounds(self):
+        """
+        Tuple of arrays with bin boundaries in the x, y and z directions (or r,
+        z and theta for cylindrical mesh), including the origin.
+        """
+        if self.__geo == 'xyz':
+            return (array([self.__ori.x] + self.__ime),
+                    array([self.__ori.y] + self.__jme),
+                    array([self.__ori.z] + self.__kme))
+        else:
+            # the first element is the default value set in __init__
+            return (array(self.__ime[1:]),
+                    array(self.__jme[1:]),
+                    array(self.__kme[1:]))
+
+    @property
+    def ebounds(self):
+        """
+        Array of energy bin boundaries, starting from 0.
+        """
+        if len(self.__eme) == 1:
+            # single energy bin, no total
+            return array([0.0] + self.__eme)
+        else:
+            return array(self.__eme)
+
+    @property
+    def shape(self):
+        """
+        Tuple (ne, ni, nj, nk) with the number of energy bins (including the
+        total, if any) and the numbers of spatial bins.
+        """
+        ni, nj, nk = [max(len(b) - 1, 0) for b in self.bounds]
+        return (len(self.__eme), ni, nj, nk)
+
+    def allocate(self, n=None):
+        """
+        Allocate arrays for `n` tally values and errors. By default, n follows
+        from the bin boundaries, see shape.
+        """
+        if n is None:
+            ne, ni, nj, nk = self.shape
+            n = ne * ni * nj * nk
+        self.__val = empty(n)
+        self.__err = empty(n)
+        return
+
+    @property
+    def rvalues(self):
+        """
+        Tally values as array of the shape (ne, ni, nj, nk), see shape. This
+        is a view of the values array.
+        """
+        return reshape(self.__val, self.shape)
+
+    @property
+    def rerrors(self):
+        """
+        Relative errors as array of the shape (ne, ni, nj, nk), see shape.
+        This is a view of the errors array.
+        """
+        return reshape(self.__err, self.shape)
+
     @property
     def values(self):
         """
-        Returns list of (value, err) tuples, in the same order as in the
-        meshtal file with 'col' format.
+        Returns array of tally values, in the same order as in the meshtal
+        file with 'col' format.
 
         Returns [] by default.
         """
         return self.__val
 
+    @values.setter
+    def values(self, value):
+        self.__val = value
+        return
+
     @property
     def errors(self):
         """
-        Returns list of errors, in the same order as values attribute.
+        Returns array of errors, in the same order as values attribute.
         """
         return self.__err
 
+    @errors.setter
+    def errors(self, value):
+        self.__err = value
+        return
+
     def items(self):
         """
-        Returns list of ((E, x, y, z), (val, err)) tuples. The order is the same as in the meshtal file with 'col' format.
+        Generator of ((E, x, y, z), (val, err)) tuples. The order is the same
+        as in the meshtal file with 'col' format.
+
+        x, y and z are coordinates of the bin centre (r, z and theta for
+        cylindrical mesh), E is the upper energy boundary of the bin, as in
+        the meshtal file, or None for the total.
         """
-        return NotImplemented
+        for b in self.blocks():
+            for (E, x, y, z, v, e) in b.tolist():
+                if E != E:
+                    E = None
+                yield ((E, x, y, z), (v, e))
+
+    def blocks(self, size=65536):
+        """
+        Generator of numpy record arrays with at most `size` records each, in
+        the same order as items(). Fields of the records are E, x, y, z (E, r,
+        z, t for cylindrical mesh), val and err. For the total, E is nan.
+
+        Bin centres are computed for each block from the bin boundaries.
+        """
+        if self.__geo == 'xyz':
+            names = ('x', 'y', 'z')
+        else:
+            names = ('r', 'z', 't')
+        val = asarray(self.__val)
+        err = asarray(self.__err)
+        dt = ([('E', float)] + [(n, float) for n in names] +
+              [('val', val.dtype), ('err', err.dtype)])
+        shape = self.shape
+        eup = self.ebounds[1:]
+        if len(eup) < shape[0]:
+            eup = append(eup, nan)
+        cen = [(b[1:] + b[:-1]) * 0.5 for b in self.bounds]
+        n = val.size
+        for start in range(0, n, size):
+            stop = min(start + size, n)
+            idx = unravel_index(arange(start, stop), shape)
+            r = empty(stop - start, dtype=dt)
+            r['E'] = eup[idx[0]]
+            for (name, c, i) in zip(names, cen, idx[1:]):
+                r[name] = c[i]
+            r['val'] = val[start:stop]
+            r['err'] = err[start:stop]
+            yield r
 
     def value(self, **kwargs):
         """
@@ -322,8 +493,65 @@ class MeshTally(object):
         correspondent tally result is returned. If E is given, the result from
         the correspondent energy bin is returned, if E is not specified, the
         total value is returned.
+
+        For cylindrical meshes, r, z and t (in revolutions) are given in the
+        mesh coordinate system, as the bin boundaries.
+        """
+        ie, i, j, k = self.index(**kwargs)
+        if ie < 0:
+            raise ValueError('Point outside of the mesh ', kwargs)
+        rv = self.rvalues
+        re = self.rerrors
+        return rv[ie, i, j, k], re[ie, i, j, k]
+
+    def index(self, **kwargs):
         """
-        return NotImplemented
+        Returns tuple of arrays (ie, i, j, k) with indices of energy and
+        spatial bins, as in rvalues, for points given by the arguments.
+        Arguments are as for value() and can be arrays, which are broadcast
+        against each other.
+
+        Bin boundaries are searched with numpy.searchsorted. Indices of points
+        outside of the mesh are -1.
+        """
+        if self.__geo == 'xyz':
+            names = ('x', 'y', 'z')
+        else:
+            names = ('r', 'z', 't')
+        for n in kwargs:
+            if n not in names + ('E', ):
+                raise ValueError('Unknown coordinate for geometry ', n, self.__geo)
+        for n in names:
+            if n not in kwargs:
+                raise ValueError('Coordinate is not given ', n)
+        pts = [kwargs[n] for n in names]
+        if 'E' in kwargs:
+            pts.append(kwargs['E'])
+        pts = broadcast_arrays(*[asarray(p, dtype=float) for p in pts])
+        ijk = [_bin_index(b, p) for (b, p) in zip(self.bounds, pts)]
+        if 'E' in kwargs:
+            ie = _bin_index(self.ebounds, pts[3])
+        else:
+            # the last energy bin is the total
+            ie = full(pts[0].shape, len(self.__eme) - 1, dtype=int)
+        # points outside in one direction are outside of the mesh
+        out = ie < 0
+        for a in ijk:
+            out = out | (a < 0)
+        return tuple(where(out, -1, a) for a in [ie] + ijk)
+
+    def values_at(self, **kwargs):
+        """
+        Vectorized form of value(). Arguments are as for index(). Returns
+        arrays of values and errors at the given points; for points outside of
+        the mesh, value and error are nan.
+        """
+        idx = self.index(**kwargs)
+        out = idx[0] < 0
+        idx = tuple(where(out, 0, a) for a in idx)
+        v = where(out, nan, self.rvalues[idx])
+        e = where(out, nan, self.rerrors[idx])
+        return v, e
 
 
     def __eq__(self, othr):
@@ -351,13 +579,351 @@ class MeshTally(object):
         return self.card(True)
 
 
-def read_meshtal(fname, use_uncertainties=True):
+# Size of chunks (in bytes) in which the table of tally results is read from
+# the meshtal file.
+_CHUNK_SIZE = 2**24
+
+_split_note = """
+    If the original line contains two entries not separated
+    by a space (e.g. the space is replaced by the minus sign
+    of a negative value), try to add spaces by the following
+    sed command:
+
+    > sed -e 's/\([0-9]\)\(-[0-9]\)/\\1 \\2/g' meshtal > meshtal.fixed
+    """
+
+
+def _parse_rows(lines, ncol, lcount):
+    """
+    Convert lines of the result table to a 2-dimensional array with `ncol`
+    columns. All lines are converted by numpy at once.
+
+    `lcount` is the number of lines in the file preceeding `lines`, used for
+    error messages.
+    """
+    # "Total" appears in the energy column when emesh is used
+    text = ''.join(lines).replace('Total', '-1')
+    a = fromstring(text, sep=' ')
+    if a.size != len(lines) * ncol:
+        # Find the line that cannot be converted
+        for i, l in enumerate(lines):
+            ll = l.replace('Total', '-1').split()
+            try:
+                if len(ll) != ncol:
+                    raise ValueError('Wrong number of entries')
+                map(str2float, ll)
+            except ValueError as e:
+                print 'Problem on line', lcount + i + 1
+                print 'Original line:'
+                print repr(l)
+                print _split_note
+                raise e
+    return a.reshape((len(lines), ncol))
+
+
+def _read_table(f, ncol, iv, ir, vals, errs, lcount):
+    """
+    Read the table with tally results from the current position in file `f`
+    up to the next empty line or to the end of file.
+
+    The table is read in chunks of _CHUNK_SIZE bytes. Columns with indices
+    `iv` and `ir` (tally values and relative errors) are copied to the
+    preallocated arrays `vals` and `errs`. The arrays are extended if the
+    table contains more rows.
+
+    Returns the arrays of values and errors, truncated to the number of table
+    rows, and the number of lines read from `f`.
+    """
+    n = 0   # number of table rows read
+    nl = 0  # number of lines read from f
+    end = False
+    while not end:
+        lines = f.readlines(_CHUNK_SIZE)
+        if not lines:
+            # end of file
+            break
+        nl += len(lines)
+        if '\n' in lines:
+            # this is the end of table with results. Lines after it belong to
+            # the next tally header: return them back to the file.
+            p = lines.index('\n')
+            rest = lines[p + 1:]
+            if rest:
+                f.seek(-len(''.join(rest)), 1)
+                nl -= len(rest)
+            lines = lines[:p]
+            end = True
+        a = _parse_rows(lines, ncol, lcount + n)
+        m = a.shape[0]
+        if n + m > vals.size:
+            # more rows than expected from the header
+            vals = concatenate((vals[:n], empty(m)))
+            errs = concatenate((errs[:n], empty(m)))
+        vals[n:n + m] = a[:, iv]
+        errs[n:n + m] = a[:, ir]
+        n += m
+    return vals[:n], errs[:n], nl
+
+
+def _read_blocks(f, res, use_uncertainties, lcount=0, ntal=None,
+                 tables=None):
+    """
+    Read tally headers and tables with results starting from the current
+    position in file `f`. Mesh tallies are put to the dictionary `res`.
+
+    Reading stops at the end of file or, when `ntal` is given, before the
+    header of the (ntal+1)-th tally.
+
+    When dictionary `tables` is given, only the header of the first tally is
+    read. Reading stops at the beginning of its table with results and
+    tables[tid] is set to (ncol, iv, ir): the number of table columns and
+    indices of the value and error columns.
+
+    `lcount` is the number of lines preceeding the current position in `f`,
+    used for error messages.
+
+    Returns the number of histories, if found, and the number of lines
+    preceeding the final position in `f`.
+    """
+    Noh = 0
+    while True:
+        l = f.readline()
+        if not l:
+            break
+        lcount += 1
+        # this is tally specifications block
+        if Noh == 0 and ' Number of histories' in l:
+            Noh = str2float(l.split()[-1])  # in meshtal number of histories is written with two zeroes after the decimal point
+        if len(l.split()) == 0:
+            # empty lines in the tally header block are ignored
+            pass
+        if 'Mesh Tally Number' in l:
+            if ntal is not None and ntal == 0:
+                # this is the next tally, not to be read. Return the line
+                # back to the file.
+                f.seek(-len(l), 1)
+                lcount -= 1
+                break
+            tid = int(l.split()[-1])
+            mt = MeshTally()
+            res[tid] = mt
+            if ntal is not None:
+                ntal -= 1
+        if ('Cylinder origin at' in l or '         origin at' in l):
+            mt.geom = 'cyl'
+            ll = l.split()
+            mt.origin = (ll[3], ll[4], ll[5][:-1]) # the last entry followed by comma
+            mt.axs = tuple(ll[8:11])
+        if 'X direction:' in l:
+            mt.imesh.pop(0) # when initialized, it is set to [1.]
+            for ll in l.split()[2:]:
+                mt.imesh.append(str2float(ll))
+            mt.origin.x = mt.imesh.pop(0)
+        if ' Y direction:' in l:
+            mt.jmesh.pop(0) # when initialized, it is set to [1.]
+            for ll in l.split()[2:]:
+                mt.jmesh.append(str2float(ll))
+            mt.origin.y = mt.jmesh.pop(0)
+        if 'Z direction:' in l:
+            if mt.geom == 'xyz':
+                mt.kmesh.pop(0) # when initialized, it is set to [1.]
+                for ll in l.split()[2:]:
+                    mt.kmesh.append(str2float(ll))
+                mt.origin.z = mt.kmesh.pop(0)
+            elif mt.geom == 'cyl':
+                for ll in l.split()[2:]:
+                    mt.jmesh.append(str2float(ll))
+            else:
+                raise ValueError('Cannot read Z direction boundaries for geometry type ', mt.geom)
+
+        if 'R direction:' in l:
+            for ll in l.split()[2:]:
+                mt.imesh.append(str2float(ll))
+        if 'Theta direction' in l:
+            # the line starts with 'Theta direction (revolutions):'
+            for ll in l.split()[3:]:
+                mt.kmesh.append(str2float(ll))
+        if 'Energy bin bound' in l:
+            lll = l.split()
+            # Remove the default 0, set by __init__
+            mt.emesh.pop(0)
+
+            # MCNP writes 'total' for tallies having more than 1 energy
+            # bin. Therefore, to use len(emesh) as a size of the values
+            # array along e-axis, emesh contains 1-st 0 for more than one
+            # energy bin, and has only one value in case of a single bin.
+            for ll in lll[3:]:
+                mt.emesh.append(str2float(ll))
+            if len(mt.emesh) == 2:
+                mt.emesh.pop(0)
+
+        if 'Rel Error' in l:
+            # this is the head line for the table with results.
+            # define the column indices containing Result and Error:
+            l = l.replace('Rel Error', 'Err')    # ensure that number of tokens after split() is equal to the number of data columns
+            l = l.replace('Rslt * Vol', 'RxV')
+            columns = l.split()
+            iv = columns.index('Result')
+            ir = columns.index('Err')
+            if tables is not None:
+                tables[tid] = (len(columns), iv, ir)
+                break
+
+            # read the whole table with tally results
+            mt.allocate()
+            vals, errs, nl = _read_table(f, len(columns), iv, ir, mt.values,
+                                         mt.errors, lcount)
+            lcount += nl
+
+            # Variable requires std_dev of the variable. In MCNP, r is a
+            # relative error, r = S/v, where S is the estimated standard
+            # deviation.
+            if use_uncertainties and _uncertainties_package():
+                from uncertainties import Variable
+                mt.values = [Variable(v, r*v) for (v, r) in zip(vals, errs)]
+            else:
+                mt.values = vals
+            mt.errors = errs
+    return Noh, lcount
+
+
+def index_meshtal(fname):
+    """
+    Scan meshtal file `fname` for tally headers and tables with results.
+
+    Returns dictionary {n: (h, t)}, where n is the tally number, h is the
+    offset (in bytes) of the line containing 'Mesh Tally Number' and t is the
+    offset of the head line of the table with results, or -1 if the tally is
+    not written in 'col' format.
+    """
+    res = {}
+    with open(fname, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return res
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            h = mm.find(b'Mesh Tally Number')
+            while h >= 0:
+                e = mm.find(b'\n', h)
+                if e < 0:
+                    e = mm.size()
+                tid = int(mm[h:e].split()[-1])
+                n = mm.find(b'Mesh Tally Number', e)
+                t = mm.find(b'Rel Error', e, n if n >= 0 else mm.size())
+                if t >= 0:
+                    t = mm.rfind(b'\n', 0, t) + 1
+                res[tid] = (mm.rfind(b'\n', 0, h) + 1, t)
+                h = n
+        finally:
+            mm.close()
+    return res
+
+
+def meshtal_index(fname):
+    """
+    Returns the index of meshtal file `fname`, see index_meshtal().
+
+    The index is stored in the sidecar file `fname`.idx and is reused while
+    size and modification time of `fname` remain unchanged.
+    """
+    st = os.stat(fname)
+    stamp = '{} {!r}'.format(st.st_size, st.st_mtime)
+    iname = fname + '.idx'
+    if os.path.exists(iname):
+        with open(iname, 'r') as f:
+            if f.readline().strip() == stamp:
+                res = {}
+                for l in f:
+                    tid, h, t = map(int, l.split())
+                    res[tid] = (h, t)
+                return res
+    res = index_meshtal(fname)
+    try:
+        with open(iname, 'w') as f:
+            f.write(stamp + '\n')
+            for tid in sorted(res.keys()):
+                f.write('{} {} {}\n'.format(tid, *res[tid]))
+    except IOError:
+        # index can be used without the sidecar file
+        pass
+    return res
+
+
+def _cache_meshtal(fname, stamp, title, nps, res, use_uncertainties):
+    """
+    Write the cache of meshtal file `fname` with title, number of histories
+    and mesh tallies `res` as returned by read_meshtal().
+    """
+    tallies = []
+    arrays = {}
+    for tid, mt in res.items():
+        tallies.append((tid, {
+            'geom': mt.geom,
+            'origin': (mt.origin.x, mt.origin.y, mt.origin.z),
+            'axs': (mt.axs.x, mt.axs.y, mt.axs.z),
+            'imesh': mt.imesh,
+            'jmesh': mt.jmesh,
+            'kmesh': mt.kmesh,
+            'emesh': mt.emesh}))
+        if use_uncertainties and _uncertainties_package():
+            vals = [v.nominal_value for v in mt.values]
+        else:
+            vals = mt.values
+        arrays['v{}'.format(tid)] = asarray(vals, dtype=float)
+        arrays['e{}'.format(tid)] = asarray(mt.errors, dtype=float)
+    meta = {'title': title, 'nps': nps, 'tallies': tallies}
+    return save_cache(fname, stamp, meta, arrays)
+
+
+def _read_cached_meshtal(c, use_uncertainties, tallies):
+    """
+    Returns (title, nps, res) from the loaded cache `c` of a meshtal file,
+    see read_meshtal().
+    """
+    meta, arrays = c
+    res = {}
+    for tid, d in meta['tallies']:
+        if tallies is not None and tid not in tallies:
+            continue
+        mt = MeshTally()
+        if d['geom'] == 'cyl':
+            mt.axs = d['axs']
+        mt.origin = d['origin']
+        mt.imesh[:] = d['imesh']
+        mt.jmesh[:] = d['jmesh']
+        mt.kmesh[:] = d['kmesh']
+        mt.emesh[:] = d['emesh']
+        vals = arrays['v{}'.format(tid)]
+        errs = arrays['e{}'.format(tid)]
+        if use_uncertainties and _uncertainties_package():
+            from uncertainties import Variable
+            mt.values = [Variable(v, r*v) for (v, r) in zip(vals, errs)]
+        else:
+            mt.values = vals
+        mt.errors = errs
+        res[tid] = mt
+    if tallies is not None:
+        for tid in tallies:
+            if tid not in res:
+                raise ValueError('Tally not found in meshtal file ', tid)
+    return meta['title'], meta['nps'], res
+
+
+def read_meshtal(fname, use_uncertainties=True, tallies=None, cache=False):
     """Reads meshtal file.
 
     Meshtal file to read is given by its name in the argument fname. Optional
     argument use_uncertainties specifies whether to use the Uncertainties
     package to store statistical error.
 
+    Optional argument tallies is a list of tally numbers to read. In this
+    case, the tallies are read from their positions in the file given by
+    meshtal_index(); other tallies are skipped.
+
+    Optional argument cache specifies whether to use the binary cache of the
+    meshtal file (see tovtk.cache). The cache is written after the whole file
+    is read, i.e. when tallies is not given.
+
     Returns a tuple (t, n, r), where:
 
         t: problem title
@@ -371,120 +937,44 @@ def read_meshtal(fname, use_uncertainties=True):
     >>> for (n, mt) in r.items():
     ...     print n
     ...     print mt.values
+    >>> t, n, r = read_meshtal('meshtal', tallies=[44])
 
     """
-    Noh = 0
-    res = {}
-    tit = [] # title
-    data_block = False          # flag to specify if results (True) or tally specs (False) are read
-    lcount = 0
-    for l in open(fname, 'r'):
-        lcount += 1
-        if len(tit) < 2:
-            # first two lines go to the tit list.
-            tit.append(l)
-        elif not data_block:
-            # this is tally specifications block
-            if Noh == 0 and ' Number of histories' in l:
-                Noh = str2float(l.split()[-1])  # in meshtal number of histories is written with two zeroes after the decimal point
-            if len(l.split()) == 0:
-                # empty lines in the tally header block are ignored
-                pass
-            if 'Mesh Tally Number' in l:
-                tid = int(l.split()[-1])
-                mt = MeshTally()
-                res[tid] = mt
-            if ('Cylinder origin at' in l or '         origin at' in l):
-                mt.geom = 'cyl'
-                ll = l.split()
-                mt.origin = (ll[3], ll[4], ll[5][:-1]) # the last entry followed by comma
-                mt.axs = tuple(ll[8:11])
-            if 'X direction:' in l:
-                mt.imesh.pop(0) # when initialized, it is set to [1.]
-                for ll in l.split()[2:]:
-                    mt.imesh.append(str2float(ll))
-                mt.origin.x = mt.imesh.pop(0)
-            if ' Y direction:' in l:
-                mt.jmesh.pop(0) # when initialized, it is set to [1.]
-                for ll in l.split()[2:]:
-                    mt.jmesh.append(str2float(ll))
-                mt.origin.y = mt.jmesh.pop(0)
-            if 'Z direction:' in l:
-                if mt.geom == 'xyz':
-                    mt.kmesh.pop(0) # when initialized, it is set to [1.]
-                    for ll in l.split()[2:]:
-                        mt.kmesh.append(str2float(ll))
-                    mt.origin.z = mt.kmesh.pop(0)
-                elif mt.geom == 'cyl':
-                    for ll in l.split()[2:]:
-                        mt.jmesh.append(str2float(ll))
-                else:
-                    raise ValueError('Cannot read Z direction boundaries for geometry type ', mt.geom)
-
-            if 'R direction:' in l:
-                for ll in l.split()[2:]:
-                    mt.imesh.append(str2float(ll))
-            if 'Theta direction:' in l:
-                for ll in l.split()[3:]:
-                    mt.kmesh.append(str2float(ll))
-            if 'Energy bin bound' in l:
-                lll = l.split()
-                # Remove the default 0, set by __init__
-                mt.emesh.pop(0)
+    tally = tallies[0] if tallies is not None and len(tallies) == 1 else None
+    with stage('read', fname, tally):
+        return _read_meshtal(fname, use_uncertainties, tallies, cache)
+
 
-                # MCNP writes 'total' for tallies having more than 1 energy
-                # bin. Therefore, to use len(emesh) as a size of the values
-                # array along e-axis, emesh contains 1-st 0 for more than one
-                # energy bin, and has only one value in case of a single bin.
-                for ll in lll[3:]:
-                    mt.emesh.append(str2float(ll))
-                if len(mt.emesh) == 2:
-                    mt.emesh.pop(0)
-
-            if 'Rel Error' in l:
-                # this is the head line for the table with results.
-                data_block = True
-                # define the column indices containing Result and Error:
-                l = l.replace('Rel Error', 'Err')    # ensure that number of tokens after split() is equal to the number of data columns
-                l = l.replace('Rslt * Vol', 'RxV')
-                columns = l.split()
-                iv = columns.index('Result')
-                ir = columns.index('Err')
+def _read_meshtal(fname, use_uncertainties, tallies, cache):
+    """
+    Reads meshtal file, see read_meshtal().
+    """
+    if cache:
+        stamp = cache_stamp(fname, 'meshtal')
+        c = load_cache(fname, stamp)
+        if c is not None:
+            return _read_cached_meshtal(c, use_uncertainties, tallies)
+    res = {}
+    with open(fname, 'r') as f:
+        # first two lines go to the tit list.
+        tit = [f.readline(), f.readline()]
+        if tallies is None:
+            Noh, lcount = _read_blocks(f, res, use_uncertainties, lcount=2)
+            count_bytes(f.tell())
         else:
-            # reading the table with tally results.
-            if l == '\n':
-                # this is the end of table with results.
-                data_block = False
-            else:
-                l = l.replace('Total', '-1') # "Total" appears when emesh is used
-                ll = l.split()
-                try:
-                    v = str2float(ll[iv])
-                    r = str2float(ll[ir])
-                except IndexError as ie:
-                    print 'Problem on line', lcount
-                    print 'Original line:'
-                    print repr(l)
-                    print """
-                        If the original line contains two entries not separated
-                        by a space (e.g. the space is replaced by the minus sign
-                        of a negative value), try to add spaces by the following
-                        sed command:
-
-                        > sed -e 's/\([0-9]\)\(-[0-9]\)/\\1 \\2/g' meshtal > meshtal.fixed
-                        """
-                    raise ie
-
-                # Variable requires std_dev of the variable. In MCNP, r is a
-                # relative error, r = S/v, where S is the estimated standard
-                # deviation.
-                if use_uncertainties and _uncertainties_package:
-                    value = Variable(v, r*v)
-                else:
-                    # value = (v, r)
-                    value = v
-                mt.values.append(value)
-                mt.errors.append(r)
+            index = meshtal_index(fname)
+            # number of histories is given before the first tally
+            Noh, lcount = _read_blocks(f, res, use_uncertainties, lcount=2,
+                                       ntal=0)
+            count_bytes(f.tell())
+            for tid in tallies:
+                if tid not in index:
+                    raise ValueError('Tally not found in meshtal file ', tid, fname)
+                # line numbers in error messages are counted from the tally
+                # header.
+                f.seek(index[tid][0])
+                _read_blocks(f, res, use_uncertainties, ntal=1)
+                count_bytes(f.tell() - index[tid][0])
+    if cache and tallies is None:
+        _cache_meshtal(fname, stamp, tit[-1], Noh, res, use_uncertainties)
     return tit[-1], Noh, res
-
-
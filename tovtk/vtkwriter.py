@@ -0,0 +1,100 @@
+# Writer of VTK XML rectilinear grid files using the vtk package
+import vtk
+from vtk.util.numpy_support import numpy_to_vtk
+from numpy import asarray, float32
+
+_vtkVersion = vtk.vtkVersion.GetVTKSourceVersion().split()[-1]
+
+# Compressor names in SetCompressorTypeTo...() methods of VTK writers
+_compressors = {'none': 'None', 'zlib': 'ZLib', 'lz4': 'LZ4', 'lzma': 'LZMA'}
+
+
+def supports(compressor):
+    """
+    Returns True if `compressor` can be used with the installed VTK version.
+    """
+    return (compressor in _compressors and
+            hasattr(vtk.vtkXMLRectilinearGridWriter,
+                    'SetCompressorTypeTo' + _compressors[compressor]))
+
+
+def vtkArray(a, name):
+    """
+    Returns vtkDoubleArray named `name` with values of 1-dimensional array
+    `a`. A 2-dimensional array of the shape (n, nc) gives a vtkDoubleArray of
+    n tuples with nc components. A float32 array gives a vtkFloatArray and an
+    integer array the VTK array of the same integer type.
+
+    When `a` is a contiguous float64, float32 or integer numpy array, the
+    returned VTK array refers to its data buffer without copying.
+    """
+    a = asarray(a)
+    if a.dtype != float32 and a.dtype.kind not in 'iu':
+        a = asarray(a, dtype=float)
+    r = numpy_to_vtk(a, deep=0)
+    r.SetName(name)
+    return r
+
+
+def write_vtk(fname, xbounds, ybounds, zbounds, cdata, descr,
+              encoding='base64', compressor='zlib', level=None,
+              block_size=None):
+    """
+    Write rectilinear grid to file `fname` with vtkXMLRectilinearGridWriter.
+
+    Arguments are as for vtr.write_vtr(). The 'lzma' compressor requires VTK
+    8.2 or later.
+    """
+    # prepare grid boundaries
+    x = vtkArray(xbounds, 'x')
+    y = vtkArray(ybounds, 'y')
+    z = vtkArray(zbounds, 'z')
+
+    # put boundaries and data into VTK rectilinear grid
+    grid = vtk.vtkRectilinearGrid()
+    grid.SetDimensions(x.GetNumberOfTuples(),
+                       y.GetNumberOfTuples(),
+                       z.GetNumberOfTuples())
+    grid.SetXCoordinates(x)
+    grid.SetYCoordinates(y)
+    grid.SetZCoordinates(z)
+
+    # Field data to store metadata
+    df = vtk.vtkStringArray()
+    df.SetName('Description')
+    df.SetNumberOfTuples(len(descr))
+    for i, s in enumerate(descr):
+        df.SetValue(i, s)
+
+    # Attach values to the grid
+    for name, a in cdata:
+        grid.GetCellData().AddArray(vtkArray(a, name))
+    grid.GetFieldData().AddArray(df)
+
+    # write to file:
+    writer = vtk.vtkXMLRectilinearGridWriter()
+    if _vtkVersion[0] in '68':
+        writer.SetInputData(grid)
+    else:
+        # _vtkVersion[0] == '5':
+        writer.SetInput(grid)
+    writer.SetFileName(fname)
+    writer.SetEncodeAppendedData(encoding == 'base64')
+    if not supports(compressor):
+        raise ValueError('Compressor not supported by VTK {}: '.format(
+                         _vtkVersion), compressor)
+    getattr(writer, 'SetCompressorTypeTo' + _compressors[compressor])()
+    if level is not None and compressor != 'none':
+        c = writer.GetCompressor()
+        if hasattr(c, 'SetCompressionLevel'):
+            c.SetCompressionLevel(level)
+        else:
+            # LZ4 compressor of VTK < 8.2, see vtr._compress_function()
+            c.SetAccelerationLevel(max(1, 10 - level))
+    if block_size is not None:
+        writer.SetBlockSize(block_size)
+    ws = writer.Write()
+    if writer.GetErrorCode() != 0:
+        # Write() returns 1 also when the output file cannot be opened.
+        ws = 0
+    return ws
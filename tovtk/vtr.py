@@ -0,0 +1,405 @@
+# Writer of VTK XML rectilinear grid files without the vtk package
+"""
+Writes .vtr files with the same layout as vtkXMLRectilinearGridWriter. By
+default, data arrays are compressed with zlib and appended in base64
+encoding. Arrays can also be appended as raw binary data, and compressed
+with LZ4 or LZMA (these require the lz4 and lzma, or backports.lzma,
+packages) or not compressed.
+"""
+import os
+import zlib
+from base64 import b64encode
+from tempfile import SpooledTemporaryFile
+from numpy import (asarray, ascontiguousarray, uint8, amin, amax, sqrt,
+                   float32, finfo, count_nonzero, isinf)
+
+# Size of blocks (in bytes) compressed separately, as in vtkXMLWriter.
+BLOCK_SIZE = 2**15
+
+# Compressed data is kept in memory up to this size, see _packed()
+_SPOOL_SIZE = 2**26
+
+# Size of chunks of data encoded at once, divisible by 3
+_ENCODE_SIZE = 3 * 2**18
+
+# Arrays larger than this (in bytes) require UInt64 headers of appended data
+_MAX_UINT32 = 2**32 - 1
+
+# Supported compressors and encodings
+COMPRESSORS = ('none', 'zlib', 'lz4', 'lzma')
+ENCODINGS = ('base64', 'raw')
+
+# Ranges of compression levels, as accepted by VTK compressors
+LEVELS = {'zlib': (1, 9), 'lz4': (1, 9), 'lzma': (1, 9)}
+
+# VTK names of numpy types
+_vtk_types = {'float64': 'Float64',
+              'float32': 'Float32',
+              'int8': 'Int8',
+              'int16': 'Int16',
+              'int32': 'Int32',
+              'int64': 'Int64',
+              'uint8': 'UInt8',
+              'uint16': 'UInt16',
+              'uint32': 'UInt32',
+              'uint64': 'UInt64'}
+
+
+def to_float32(a):
+    """
+    Returns array `a` converted to float32 and the number of its values
+    outside of the float32 range: nonzero values below the smallest normal
+    float32 number, which lose precision or become zero, and finite values
+    which become infinite.
+    """
+    a = asarray(a)
+    b = a.astype(float32)
+    m = abs(b)
+    n = count_nonzero((m < finfo(float32).tiny) & (a != 0.0))
+    n += count_nonzero(isinf(m) & ~isinf(a))
+    return b, n
+
+
+def _compress_function(compressor, level):
+    """
+    Returns the VTK class name of `compressor` and the function compressing a
+    string with the compression `level` (None for the default level).
+    """
+    if compressor == 'zlib':
+        if level is None:
+            return 'vtkZLibDataCompressor', zlib.compress
+        return 'vtkZLibDataCompressor', lambda d: zlib.compress(d, level)
+    elif compressor == 'lz4':
+        try:
+            import lz4.block
+        except ImportError:
+            raise ValueError('LZ4 compression requires the lz4 package')
+        # as in vtkLZ4DataCompressor, higher level means lower acceleration
+        acc = 1 if level is None else max(1, 10 - level)
+        return 'vtkLZ4DataCompressor', lambda d: lz4.block.compress(
+            d, mode='fast', acceleration=acc, store_size=False)
+    elif compressor == 'lzma':
+        try:
+            import lzma
+        except ImportError:
+            try:
+                from backports import lzma
+            except ImportError:
+                raise ValueError('LZMA compression requires the lzma or '
+                                 'backports.lzma package')
+        preset = 6 if level is None else level
+        return 'vtkLZMADataCompressor', lambda d: lzma.compress(
+            d, format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC32, preset=preset)
+    elif compressor == 'none':
+        return None, None
+    raise ValueError('Unknown compressor ', compressor)
+
+
+def _packed(buf, compress, block_size, htype='<u4'):
+    """
+    Returns data in the 1-dimensional uint8 array `buf` prepared for VTK
+    appended data as the tuple (header, tmp) of the string, which is encoded
+    separately, and the temporary file with the rest of the data.
+
+    Compressed data is split into blocks of `block_size` bytes compressed by
+    function `compress`; the header contains sizes of the compressed blocks.
+    When `compress` is None, the header with the data size is the beginning
+    of the temporary file. Header values have the numpy type `htype`, '<u4'
+    or '<u8' for header_type UInt32 or UInt64.
+
+    Blocks are processed one by one, so that `buf` can be a memory-mapped
+    array larger than the available memory. The temporary file is kept in
+    memory, while it is small.
+    """
+    n = buf.size
+    tmp = SpooledTemporaryFile(_SPOOL_SIZE)
+    if compress is None:
+        tmp.write(asarray([n], dtype=htype).tobytes())
+        for i in range(0, n, block_size):
+            tmp.write(buf[i:i + block_size].tobytes())
+        return b'', tmp
+    sizes = []
+    for i in range(0, n, block_size):
+        b = compress(buf[i:i + block_size].tobytes())
+        sizes.append(len(b))
+        tmp.write(b)
+    header = asarray([len(sizes), block_size, n % block_size] + sizes,
+                     dtype=htype)
+    return header.tobytes(), tmp
+
+
+def _encoded_size(header, tmp, encoding):
+    """
+    Returns the length of the appended data with `header` and the rest of
+    data in the file `tmp` in `encoding`.
+    """
+    if encoding == 'raw':
+        return len(header) + tmp.tell()
+    return (len(header) + 2) // 3 * 4 + (tmp.tell() + 2) // 3 * 4
+
+
+def _write_encoded(f, header, tmp, encoding):
+    """
+    Write appended data with `header` and the rest of data from `tmp` to file
+    `f`. In base64 encoding, the header and the rest are encoded separately.
+    The rest is encoded in chunks with the length divisible by 3, which gives
+    the same result as encoding of the whole data.
+    """
+    enc = b64encode if encoding == 'base64' else str
+    f.write(enc(header))
+    tmp.seek(0)
+    while True:
+        d = tmp.read(_ENCODE_SIZE)
+        if not d:
+            break
+        f.write(enc(d))
+    tmp.close()
+    return
+
+
+def _range(a):
+    """
+    Returns strings with min and max values of array `a`. For arrays with
+    several components, range of the magnitude is returned, as in VTK.
+    """
+    if a.size == 0:
+        return '', ''
+    if a.ndim > 1:
+        a = sqrt((a**2).sum(axis=1))
+    return '{:g}'.format(amin(a)), '{:g}'.format(amax(a))
+
+
+def _data_array(a, name, offset, indent):
+    """
+    Returns the DataArray XML element for array `a`.
+    """
+    attrs = 'type="{}" Name="{}"'.format(_vtk_types[a.dtype.name], name)
+    if a.ndim > 1:
+        attrs += ' NumberOfComponents="{}"'.format(a.shape[1])
+    rmin, rmax = _range(a)
+    attrs += ' format="appended" RangeMin="{}" RangeMax="{}" offset="{}"'.format(
+             rmin, rmax, offset)
+    return '{}<DataArray {} />\n'.format(' '*indent, attrs)
+
+
+def write_vtr(fname, xbounds, ybounds, zbounds, cdata, descr, start=(0, 0, 0),
+              encoding='base64', compressor='zlib', level=None,
+              block_size=BLOCK_SIZE):
+    """
+    Write rectilinear grid to file `fname`.
+
+    Arrays xbounds, ybounds and zbounds are boundary coordinates. `cdata` is
+    a list of (name, array) tuples of cell data. Array of the shape (n, ) is
+    written as scalar array, array of the shape (n, nc) as array with nc
+    components. Values must be in VTK order of cells, i.e. x index changes
+    fastest.
+
+    Strings from `descr` are written to the field data array `Description`.
+
+    Optional `start` gives indices of the first point in the grid extent. It
+    is used for pieces of a larger grid, see write_pvtr().
+
+    Appended data is written in `encoding`, 'base64' or 'raw'. `compressor`
+    is one of COMPRESSORS, `level` is the compression level (None for the
+    default of the compressor) and `block_size` is the size of blocks
+    compressed separately.
+
+    Returns 1 on success and 0 if the file cannot be written, as
+    vtkXMLWriter.Write().
+    """
+    if encoding not in ENCODINGS:
+        raise ValueError('Unknown encoding ', encoding)
+    cname, compress = _compress_function(compressor, level)
+    coords = [('x', asarray(xbounds, dtype='<f8')),
+              ('y', asarray(ybounds, dtype='<f8')),
+              ('z', asarray(zbounds, dtype='<f8'))]
+    cdata = [(name, ascontiguousarray(a, dtype=a.dtype.newbyteorder('<')))
+             for (name, a) in cdata]
+    extent = ' '.join('{} {}'.format(s, s + len(c) - 1)
+                      for (s, (n, c)) in zip(start, coords))
+    # sizes in headers of appended data must fit the header type, which is
+    # the same for all arrays in the file
+    nmax = max([a.nbytes for (n, a) in coords + cdata] + [block_size])
+    if nmax > _MAX_UINT32:
+        htype, hname = '<u8', 'UInt64'
+    else:
+        htype, hname = '<u4', 'UInt32'
+
+    # packed data in order of appearance in the file
+    appended = []
+    offset = 0
+
+    # strings are written as null-terminated sequences of characters
+    s = b''.join(str(d) + b'\0' for d in descr)
+    appended.append(_packed(asarray(bytearray(s), dtype=uint8), compress,
+                            block_size, htype))
+    xml = ['<?xml version="1.0"?>\n',
+           '<VTKFile type="RectilinearGrid" version="0.1" '
+           'byte_order="LittleEndian" header_type="{}"{}>\n'.format(
+               hname,
+               '' if cname is None else ' compressor="{}"'.format(cname)),
+           '  <RectilinearGrid WholeExtent="{}">\n'.format(extent),
+           '    <FieldData>\n',
+           '      <Array type="String" Name="Description" NumberOfTuples="{}" '
+           'format="appended" offset="0" />\n'.format(len(descr)),
+           '    </FieldData>\n',
+           '    <Piece Extent="{}">\n'.format(extent),
+           '      <PointData>\n',
+           '      </PointData>\n',
+           '      <CellData>\n']
+    offset += _encoded_size(*appended[-1] + (encoding, ))
+    for name, a in cdata:
+        xml.append(_data_array(a, name, offset, 8))
+        appended.append(_packed(a.reshape(-1).view(uint8), compress,
+                                block_size, htype))
+        offset += _encoded_size(*appended[-1] + (encoding, ))
+    xml.append('      </CellData>\n')
+    xml.append('      <Coordinates>\n')
+    for name, a in coords:
+        xml.append(_data_array(a, name, offset, 8))
+        appended.append(_packed(a.view(uint8), compress, block_size,
+                                htype))
+        offset += _encoded_size(*appended[-1] + (encoding, ))
+    xml.extend(['      </Coordinates>\n',
+                '    </Piece>\n',
+                '  </RectilinearGrid>\n',
+                '  <AppendedData encoding="{}">\n'.format(encoding),
+                '   _'])
+    try:
+        with open(fname, 'wb') as f:
+            f.write(''.join(xml))
+            for header, tmp in appended:
+                _write_encoded(f, header, tmp, encoding)
+            f.write('\n  </AppendedData>\n</VTKFile>\n')
+    except IOError as e:
+        print 'Error writing {}: {}'.format(fname, e)
+        return 0
+    return 1
+
+
+def partition(shape, pieces):
+    """
+    Returns list of cell index ranges ((i0, i1), (j0, j1), (k0, k1)) of
+    pieces of the grid with `shape` cells.
+
+    `pieces` is either the tuple with the number of pieces along each axis, or
+    the number of pieces along the axis with the largest number of cells.
+    Pieces along an axis have equal number of cells, up to one.
+    """
+    if isinstance(pieces, int):
+        n = pieces
+        pieces = [1, 1, 1]
+        pieces[list(shape).index(max(shape))] = n
+    ranges = []
+    for n, p in zip(shape, pieces):
+        p = max(1, min(p, n))
+        b = [n * i // p for i in range(p + 1)]
+        ranges.append(zip(b[:-1], b[1:]))
+    return [(ri, rj, rk) for rk in ranges[2]
+                         for rj in ranges[1]
+                         for ri in ranges[0]]
+
+
+def write_pvtr(fname, xbounds, ybounds, zbounds, cdata, descr, pieces,
+               nthreads=None, **options):
+    """
+    Write rectilinear grid split into pieces to the parallel VTK file `fname`
+    (with extension .pvtr) and pieces to files `fname`_N.vtr.
+
+    Arguments are as for write_vtr(), `pieces` is as for partition(). Pieces
+    share boundary points, but not cells. The description is written to each
+    piece; the parallel file has no field data, and the VTK parallel reader
+    does not take it from the pieces. Pieces are written concurrently in
+    `nthreads` threads (by default, one per piece up to the number of CPUs);
+    the time-consuming compression does not hold the Python interpreter lock.
+    Keyword `options` (encoding, compressor, etc.) are passed to write_vtr().
+
+    Returns 1 on success and 0 if some of the files cannot be written.
+    """
+    from multiprocessing import cpu_count
+    from multiprocessing.pool import ThreadPool
+    coords = [asarray(xbounds, dtype='<f8'),
+              asarray(ybounds, dtype='<f8'),
+              asarray(zbounds, dtype='<f8')]
+    shape = tuple(len(c) - 1 for c in coords)
+    # cell data as arrays of the shape (nx, ny, nz) or (nx, ny, nz, nc)
+    cdata = [(name, a.reshape(shape + a.shape[1:], order='F'))
+             for (name, a) in cdata]
+
+    base = fname[:-5] if fname.endswith('.pvtr') else fname
+    tasks = []
+    cname = _compress_function(options.get('compressor', 'zlib'), None)[0]
+    xml = ['<?xml version="1.0"?>\n',
+           '<VTKFile type="PRectilinearGrid" version="0.1" '
+           'byte_order="LittleEndian" header_type="UInt32"{}>\n'.format(
+               '' if cname is None else ' compressor="{}"'.format(cname)),
+           '  <PRectilinearGrid WholeExtent="0 {} 0 {} 0 {}" '
+           'GhostLevel="0">\n'.format(*shape),
+           '    <PCellData>\n']
+    for name, a in cdata:
+        attrs = 'type="{}" Name="{}"'.format(
+            _vtk_types[a.dtype.name], name)
+        if a.ndim > 3:
+            attrs += ' NumberOfComponents="{}"'.format(a.shape[3])
+        xml.append('      <PDataArray {} />\n'.format(attrs))
+    xml.append('    </PCellData>\n')
+    xml.append('    <PCoordinates>\n')
+    for name in 'xyz':
+        xml.append('      <PDataArray type="Float64" Name="{}" />\n'.format(
+                   name))
+    xml.append('    </PCoordinates>\n')
+    for n, ((i0, i1), (j0, j1), (k0, k1)) in enumerate(
+            partition(shape, pieces)):
+        pname = '{}_{}.vtr'.format(base, n)
+        pdata = []
+        for name, a in cdata:
+            a = a[i0:i1, j0:j1, k0:k1]
+            pdata.append((name, a.reshape((-1, ) + a.shape[3:], order='F')))
+        tasks.append((pname, coords[0][i0:i1 + 1], coords[1][j0:j1 + 1],
+                      coords[2][k0:k1 + 1], pdata, descr, (i0, j0, k0)))
+        xml.append('    <Piece Extent="{} {} {} {} {} {}" Source="{}" />\n'.format(
+                   i0, i1, j0, j1, k0, k1, os.path.basename(pname)))
+    xml.extend(['  </PRectilinearGrid>\n',
+                '</VTKFile>\n'])
+
+    pool = ThreadPool(nthreads or min(len(tasks), cpu_count()))
+    ws = pool.map(lambda args: write_vtr(*args, **options), tasks)
+    pool.close()
+    pool.join()
+    if not all(ws):
+        return 0
+    try:
+        with open(fname, 'wb') as f:
+            f.write(''.join(xml))
+    except IOError as e:
+        print 'Error writing {}: {}'.format(fname, e)
+        return 0
+    return 1
+
+
+def write_pvd(fname, steps):
+    """
+    Write the VTK collection file `fname` (with extension .pvd) with the list
+    of `steps`, (timestep, file name) tuples. File names are written relative
+    to the directory of `fname`.
+
+    Returns 1 on success and 0 if the file cannot be written.
+    """
+    d = os.path.dirname(os.path.abspath(fname))
+    xml = ['<?xml version="1.0"?>\n',
+           '<VTKFile type="Collection" version="0.1" '
+           'byte_order="LittleEndian">\n',
+           '  <Collection>\n']
+    for t, f in steps:
+        xml.append('    <DataSet timestep="{!r}" group="" part="0" '
+                   'file="{}" />\n'.format(
+                       t, os.path.relpath(os.path.abspath(f), d)))
+    xml.extend(['  </Collection>\n',
+                '</VTKFile>\n'])
+    try:
+        with open(fname, 'wb') as f:
+            f.write(''.join(xml))
+    except IOError as e:
+        print 'Error writing {}: {}'.format(fname, e)
+        return 0
+    return 1
@@ -0,0 +1,113 @@
+# Incremental conversion of meshtal files while they are written
+"""
+MCNP writes meshtal files periodically during long runs. In the watch mode,
+meshtal files are checked every few seconds; when a file has changed and
+its size and modification time remained the same for one interval (i.e.
+the file is completely written), its index of tally headers is rebuilt (see
+tovtk.tallies.meshtal_index()) and the checksum of each tally block, from
+its header to the next one, is compared with the checksum of the last
+conversion. Only meshtallies with changed blocks are read and written.
+
+A meshtally whose results did not change is not written again, even if the
+number of histories in the file has changed.
+"""
+import os
+import mmap
+import time
+import zlib
+from .tallies import meshtal_index, read_meshtal
+
+# Default interval between checks, in seconds
+INTERVAL = 10.0
+
+# Size of chunks for checksums
+_CHUNK_SIZE = 2**24
+
+
+def _stamp(fname):
+    """
+    Returns (size, modification time) of file `fname`, or None if it does not
+    exist.
+    """
+    try:
+        st = os.stat(fname)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime
+
+
+def checksums(fname, index):
+    """
+    Returns dictionary {n: (length, crc)} with the length and the CRC-32
+    checksum of the block of each meshtally in file `fname` with `index`.
+    The block of a meshtally extends from its header to the header of the
+    next one, or to the end of the file.
+    """
+    res = {}
+    starts = sorted((h, n) for (n, (h, t)) in index.items())
+    with open(fname, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return res
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            ends = [h for (h, n) in starts[1:]] + [size]
+            for (h, n), e in zip(starts, ends):
+                crc = 0
+                for i in range(h, e, _CHUNK_SIZE):
+                    crc = zlib.crc32(mm[i:min(i + _CHUNK_SIZE, e)], crc)
+                res[n] = (e - h, crc)
+        finally:
+            mm.close()
+    return res
+
+
+def watch(meshtals, interval=INTERVAL, **kwargs):
+    """
+    Generator of (log, ws) tuples, as tovtk.main.write_tally(), for
+    meshtallies in files `meshtals` written each time their blocks change.
+    Files are checked every `interval` seconds; the generator does not stop.
+    Keyword arguments `kwargs` are passed to write_tally().
+
+    Files are converted after they remain unchanged for one interval, also
+    at the start. Meshtallies that cannot be read or written are tried again
+    after the next change of the file.
+    """
+    from .main import write_tally
+    # stamps seen at the previous check and of the last conversion
+    seen = {}
+    done = {}
+    # checksums of converted meshtally blocks, for each file
+    sums = dict((m, {}) for m in meshtals)
+    while True:
+        for meshtal in meshtals:
+            s = _stamp(meshtal)
+            previous, seen[meshtal] = seen.get(meshtal), s
+            if s is None or s != previous or s == done.get(meshtal):
+                # missing, still being written or already converted
+                continue
+            done[meshtal] = s
+            index = meshtal_index(meshtal)
+            # only meshtallies with tables in the 'col' format are converted
+            new = dict((n, c) for (n, c) in checksums(meshtal, index).items()
+                       if index[n][1] >= 0)
+            old = sums[meshtal]
+            changed = [n for n in sorted(new) if new[n] != old.get(n)]
+            log = ['{}: {} of {} meshtallies changed'.format(
+                   meshtal, len(changed), len(new))]
+            if changed:
+                try:
+                    title, nps, td = read_meshtal(
+                        meshtal, use_uncertainties=False, tallies=changed)
+                except (ValueError, IndexError) as e:
+                    yield log + ['Cannot read {}: {}'.format(meshtal, e)], None
+                    continue
+            yield log, None
+            for n in changed:
+                log, ws = write_tally(meshtal, n, td.pop(n), title, nps,
+                                      **kwargs)
+                # not rectangular meshtallies (ws is None) are not tried again
+                if ws is None or ws == 1:
+                    old[n] = new[n]
+                yield log, ws
+        time.sleep(interval)